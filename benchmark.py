@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+
+# standard libraries
+import argparse
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import redirect_stderr
+from traceback import format_exc
+# numpy
+import numpy as np
+# local libraries
+import bin_writer
+import finddups
+import gen_conf
+import get_kaiju_otu
+import lineage_lookup
+import taxonomy_index
+
+"""
+MIT License
+"""
+_epilog = """
+This program measures the throughput of the binning scripts on synthetic data.
+It generates gzipped FASTQ files (single and interleaved paired), matching
+Kaiju output and a small NCBI Taxonomy (nodes.dmp/names.dmp), so no network
+access or real databases are needed. Every benchmark runs in a separate process
+and reports the wall and CPU time, reads/s, MB/s and the peak RSS of that
+process. The results are written as JSON and can be compared against the
+results of an earlier version with --compare to catch throughput regressions.
+"""
+
+# ranks of the synthetic taxonomy, with the amount of taxa per rank relative to the amount of species
+_taxonomy_levels = (
+    ("superkingdom", 0.002), ("phylum", 0.02), ("class", 0.05), ("order", 0.1), ("family", 0.2), ("genus", 0.4),
+    ("species", 1.0))
+# rank(s) used by the binning benchmarks
+BENCH_RANKS = ("phylum",)
+
+
+def main(args):
+    if args.compare and not os.path.exists(args.compare):
+        raise FileNotFoundError("Benchmark result file %s does not exist." % args.compare)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mg-readfiltering-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        data = generate_dataset(workdir, args.reads, args.taxa, args.samples, args.seed)
+        data["threads"] = args.threads
+        results = OrderedDict()
+        for name, setup in BENCHMARKS.items():
+            if args.benchmarks and name not in args.benchmarks:
+                continue
+            logging.info("Running benchmark %s ..." % name)
+            results[name] = run_benchmark(setup, data)
+            logging.info("%s: %.2f s, %.0f reads/s, %.1f MB/s, %.1f MB peak RSS" % (
+                name, results[name]["seconds"], results[name]["reads_per_s"], results[name]["mb_per_s"],
+                results[name]["peak_rss_mb"]))
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = OrderedDict()
+    report["label"] = args.label
+    report["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    report["python"] = platform.python_version()
+    report["parameters"] = OrderedDict(
+        [("reads", args.reads), ("taxa", args.taxa), ("samples", args.samples), ("threads", args.threads),
+         ("seed", args.seed)])
+    report["results"] = results
+    with open(args.output, "w") as fout:
+        json.dump(report, fout, indent=2)
+    logging.info("Benchmark results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare, "r") as fin:
+            baseline = json.load(fin)
+        regressions = compare_results(baseline["results"], results, args.tolerance)
+        if regressions:
+            raise Exception("Throughput regressed in %d benchmark(s): %s" % (len(regressions), ", ".join(regressions)))
+
+
+def compare_results(baseline, results, tolerance):
+    """
+    Returns the names of the benchmarks that process fewer reads per second than the baseline (minus the tolerance).
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["reads_per_s"] / max(baseline[name]["reads_per_s"], 1e-9)
+        logging.info("%s: %.2fx the throughput of the baseline" % (name, ratio))
+        if ratio < 1 - tolerance:
+            logging.warning("%s regressed from %.0f to %.0f reads/s" % (
+                name, baseline[name]["reads_per_s"], result["reads_per_s"]))
+            regressions.append(name)
+    return regressions
+
+
+def run_benchmark(setup, data):
+    """
+    Runs a benchmark in a forked process, so the peak RSS is measured for this benchmark only.
+    """
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_benchmark_process, args=(setup, data, child))
+    proc.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = None
+    proc.join()
+    if isinstance(result, Exception) or result is None:
+        raise Exception("Benchmark failed: %s" % result)
+    return result
+
+
+def _benchmark_process(setup, data, conn):
+    try:
+        func, nreads, nbytes = setup(data)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        func()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        result = OrderedDict()
+        result["reads"] = nreads
+        result["bytes"] = nbytes
+        result["seconds"] = wall
+        result["cpu_seconds"] = cpu
+        result["reads_per_s"] = nreads / max(wall, 1e-9)
+        result["mb_per_s"] = nbytes / (1024 * 1024) / max(wall, 1e-9)
+        result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        conn.send(result)
+    except Exception as ex:
+        logging.debug(format_exc())
+        conn.send(Exception(str(ex)))
+    finally:
+        conn.close()
+
+
+# Synthetic data generators
+
+def generate_taxonomy(dmpdir, ntaxa, rng):
+    """
+    Writes a small NCBI Taxonomy with about ntaxa species to nodes.dmp and names.dmp. Returns the TaxIDs of the
+    genera and species.
+    """
+    os.makedirs(dmpdir, exist_ok=True)
+    nodes = [(1, 1, "no rank", "root")]
+    parents = [1]
+    nexttaxid = 10
+    leaves = []
+    for rank, fraction in _taxonomy_levels:
+        taxids = list(range(nexttaxid, nexttaxid + max(1, int(ntaxa * fraction))))
+        nexttaxid += len(taxids)
+        for taxid in taxids:
+            nodes.append((taxid, parents[rng.integers(len(parents))], rank, "%s %d" % (rank, taxid)))
+        if rank in ("genus", "species"):
+            leaves.extend(taxids)
+        parents = taxids
+    with open(os.path.join(dmpdir, "nodes.dmp"), "w") as nodesout, \
+            open(os.path.join(dmpdir, "names.dmp"), "w") as namesout:
+        for taxid, parent, rank, name in nodes:
+            nodesout.write("%d\t|\t%d\t|\t%s\t|\t\t|\n" % (taxid, parent, rank))
+            namesout.write("%d\t|\t%s\t|\t\t|\tscientific name\t|\n" % (taxid, name))
+    return leaves
+
+
+def generate_records(readids, readlen, rng, suffix=b""):
+    """
+    Returns random FASTQ records with the given read IDs.
+    """
+    bases = np.frombuffer(b"ACGTN", dtype=np.uint8)[rng.choice(5, size=(len(readids), readlen),
+                                                                p=[0.24, 0.24, 0.24, 0.24, 0.04])]
+    quals = rng.integers(35, 74, size=(len(readids), readlen), dtype=np.uint8)
+    return [b"@%s%s\n%s\n+\n%s\n" % (readid, suffix, seq.tobytes(), qual.tobytes())
+            for readid, seq, qual in zip(readids, bases, quals)]
+
+
+def generate_fastq(fqfile, readids, readlen, rng, paired=False):
+    """
+    Writes a gzipped FASTQ file with the given read IDs (interleaved mates when paired). Returns the uncompressed size.
+    """
+    size = 0
+    with gzip.open(fqfile, "wb", compresslevel=1) as fout:
+        for start in range(0, len(readids), 10000):
+            chunk = readids[start:start + 10000]
+            if paired:
+                mates = zip(generate_records(chunk, readlen, rng, b" 1:N:0:ACGT"),
+                            generate_records(chunk, readlen, rng, b" 2:N:0:ACGT"))
+                records = [record for pair in mates for record in pair]
+            else:
+                records = generate_records(chunk, readlen, rng)
+            data = b"".join(records)
+            size += len(data)
+            fout.write(data)
+    return size
+
+
+def generate_kaiju(kaijufile, readids, taxids, rng, classified=0.7):
+    """
+    Writes Kaiju output for the given read IDs, in the same order. Some reads get a TaxID that is not in the
+    taxonomy.
+    """
+    status = rng.random(len(readids))
+    assigned = np.asarray(taxids)[rng.integers(len(taxids), size=len(readids))]
+    with open(kaijufile, "wb") as fout:
+        for readid, p, taxid in zip(readids, status.tolist(), assigned.tolist()):
+            if p < classified:
+                fout.write(b"C\t%s\t%d\n" % (readid, taxid if p > 0.01 else 999999999))
+            else:
+                fout.write(b"U\t%s\t0\n" % readid)
+
+
+def generate_dataset(workdir, nreads, ntaxa, nsamples, seed):
+    """
+    Generates all the input files of the benchmarks in the working directory.
+    """
+    rng = np.random.default_rng(seed)
+    data = {"workdir": workdir, "reads": nreads}
+    logging.info("Generating taxonomy with %d species ..." % ntaxa)
+    data["dmpdir"] = os.path.join(workdir, "taxonomy")
+    data["leaves"] = generate_taxonomy(data["dmpdir"], ntaxa, rng)
+    data["taxindex"] = os.path.join(workdir, "taxonomy_index")
+    os.makedirs(data["taxindex"], exist_ok=True)
+    taxonomy_index.build_index(data["dmpdir"], data["taxindex"])
+
+    readids = [b"SYNTH:1:FC:1:%d:%d" % (i // 100000 + 1101, i % 100000) for i in range(nreads)]
+    logging.info("Generating %d single and %d paired reads ..." % (nreads, nreads))
+    data["fastq"] = os.path.join(workdir, "single.fq.gz")
+    data["fastq_bytes"] = generate_fastq(data["fastq"], readids, 150, rng)
+    data["paired"] = os.path.join(workdir, "paired.fq.gz")
+    data["paired_bytes"] = generate_fastq(data["paired"], readids, 150, rng, paired=True)
+    data["kaiju"] = os.path.join(workdir, "single.tsv")
+    generate_kaiju(data["kaiju"], readids, data["leaves"], rng)
+    data["paired_kaiju"] = os.path.join(workdir, "paired.tsv")
+    generate_kaiju(data["paired_kaiju"], readids, data["leaves"], rng)
+
+    logging.info("Generating bins of %d samples ..." % nsamples)
+    data["bindirs"] = []
+    data["bin_bytes"] = 0
+    binnames = ["root"] + ["bin%d" % i for i in range(9)]
+    perbin = max(1, nreads // (nsamples * len(binnames)))
+    for sample in range(nsamples):
+        bindir = os.path.join(workdir, "bins", "MG%d_paired" % (sample + 1))
+        os.makedirs(bindir, exist_ok=True)
+        for binname in binnames:
+            data["bin_bytes"] += generate_fastq(os.path.join(bindir, binname + ".fq.gz"), readids[:perbin], 150, rng)
+        data["bindirs"].append(bindir)
+    data["bin_reads"] = perbin * len(binnames) * nsamples
+
+    logging.info("Generating raw read tree of %d samples ..." % nsamples)
+    data["rawdir"] = os.path.join(workdir, "data")
+    for sample in range(nsamples):
+        for lane in range(1, 5):
+            lanedir = os.path.join(data["rawdir"], "run%d" % (sample % 3), "lane%d" % lane)
+            os.makedirs(lanedir, exist_ok=True)
+            for direction in ("R1", "R2"):
+                fname = "I16-1249-%02d-MG%d_ACGT-TGCA_L%03d_%s_001.fastq.gz" % (sample + 1, sample + 1, lane, direction)
+                generate_fastq(os.path.join(lanedir, fname), readids[:10], 150, rng)
+    data["raw_files"] = nsamples * 4 * 2
+    return data
+
+
+# Benchmarks: each returns the function to time, the amount of reads and the amount of bytes it processes
+
+def bench_get_fqid_taxid(data):
+    lineage_lookup.load_taxonomy_index(data["taxindex"])
+    func = lambda: get_kaiju_otu.get_fqid_taxid(BENCH_RANKS, data["kaiju"], data["threads"])
+    return func, data["reads"], os.path.getsize(data["kaiju"])
+
+
+def bench_get_bin(data):
+    lineage_lookup.load_taxonomy_index(data["taxindex"])
+    with open(data["kaiju"], "rb") as fin:
+        fqids = dict((fields[1], int(fields[2])) for fields in (line.split() for line in fin) if fields[0] == b"C")
+
+    def func():
+        for fqid in fqids:
+            lineage_lookup.get_bin(BENCH_RANKS[0], fqid, fqids)
+    return func, len(fqids), 0
+
+
+def _bench_bin_reads(data, fastq, kaiju, nbytes, nreads):
+    lineage_lookup.load_taxonomy_index(data["taxindex"])
+    fqid2otu, binnames = get_kaiju_otu.get_fqid_taxid(BENCH_RANKS, kaiju, data["threads"])
+    outdir = os.path.join(data["workdir"], "out_%d" % os.getpid())
+
+    def func():
+        writers = bin_writer.BinWriterPool(data["threads"])
+        try:
+            os.makedirs(outdir, exist_ok=True)
+            fhandles = get_kaiju_otu.RankFiles([get_kaiju_otu.BinFiles(outdir, "", True, writers)])
+            get_kaiju_otu.bin_reads(fqid2otu, fastq, fhandles)
+        finally:
+            writers.close()
+            shutil.rmtree(outdir, ignore_errors=True)
+    return func, nreads, nbytes
+
+
+def bench_bin_reads(data):
+    return _bench_bin_reads(data, data["fastq"], data["kaiju"], data["fastq_bytes"], data["reads"])
+
+
+def bench_bin_reads_paired(data):
+    return _bench_bin_reads(data, data["paired"], data["paired_kaiju"], data["paired_bytes"], 2 * data["reads"])
+
+
+def bench_finddups(data):
+    outdir = os.path.join(data["workdir"], "merged_%d" % os.getpid())
+
+    def func():
+        try:
+            with open(os.devnull, "w") as devnull, redirect_stderr(devnull):
+                finddups.main(data["bindirs"] + [outdir], data["threads"])
+        finally:
+            shutil.rmtree(outdir, ignore_errors=True)
+    return func, data["bin_reads"], data["bin_bytes"]
+
+
+def bench_get_sample_files(data):
+    return lambda: gen_conf.get_sample_files(data["rawdir"]), data["raw_files"], 0
+
+
+BENCHMARKS = OrderedDict([
+    ("get_fqid_taxid", bench_get_fqid_taxid),
+    ("lineage_lookup.get_bin", bench_get_bin),
+    ("bin_reads", bench_bin_reads),
+    ("bin_reads_paired", bench_bin_reads_paired),
+    ("finddups.main", bench_finddups),
+    ("gen_conf.get_sample_files", bench_get_sample_files),
+])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Benchmarks the binning scripts on synthetic data.",
+                                     epilog=_epilog)
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+    # Required arguments
+    required.add_argument("-o", "--output", help="Output location of the benchmark results (JSON)", action="store",
+                          type=str, required=True)
+    # Optional arguments
+    optional.add_argument("-n", "--reads", help="Number of synthetic reads (pairs for the paired data)", type=int,
+                          default=200000)
+    optional.add_argument("--taxa", help="Number of species in the synthetic taxonomy", type=int, default=2000)
+    optional.add_argument("--samples", help="Number of samples for the merging and discovery benchmarks", type=int,
+                          default=8)
+    optional.add_argument("--seed", help="Seed of the data generators", type=int, default=42)
+    optional.add_argument("-b", "--benchmarks", help="Only run the given benchmarks (any of %s)" % ", ".join(BENCHMARKS),
+                          nargs="+", choices=list(BENCHMARKS), metavar="NAME")
+    optional.add_argument("-c", "--compare", help="Compare the throughput against an earlier result file", type=str)
+    optional.add_argument("--tolerance", help="Allowed relative throughput loss when comparing", type=float,
+                          default=0.1)
+    optional.add_argument("--label", help="Label stored with the results (e.g. the version)", type=str, default="")
+    optional.add_argument("-w", "--workdir", help="Directory for the synthetic data (default: a temporary directory)",
+                          type=str)
+    optional.add_argument("-k", "--keep", help="Keep the temporary directory with the synthetic data",
+                          action="store_true")
+    optional.add_argument("--threads", help="Specify the number of threads to use", type=int, action="store", default=1)
+    # Standard arguments
+    optional.add_argument("-v", "--verbose", help="Increase verbosity level", action="count")
+    optional.add_argument("-q", "--silent", help="Suppresses output messages, overriding the --verbose argument",
+                          action="store_true")
+    optional.add_argument("-l", "--log", help="Set the logging output location", action="store",
+                          type=argparse.FileType('w'), default=sys.stderr)
+    optional.add_argument("-V", "--version", action="version", version="1.0")
+    parser._action_groups.append(optional)
+    args = parser.parse_args()
+
+    loglvl = logging.WARNING
+    if args.silent:
+        loglvl = logging.ERROR
+    elif not args.verbose:
+        pass
+    elif args.verbose >= 2:
+        loglvl = logging.DEBUG
+    elif args.verbose == 1:
+        loglvl = logging.INFO
+    logging.basicConfig(format="[%(asctime)s] %(levelname)s: %(message)s", level=loglvl, stream=args.log)
+    logging.debug("Setting verbosity level to %s" % logging.getLevelName(loglvl))
+
+    exitcode = 0
+    try:
+        main(args)
+    except Exception as ex:
+        exitcode = 1
+        logging.error(ex)
+        logging.debug(format_exc())
+    finally:
+        logging.debug("Shutting down logging system ...")
+        logging.shutdown()
+    sys.exit(exitcode)
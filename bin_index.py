@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# standard libraries
+import argparse
+import bisect
+import gzip
+import logging
+import os
+import struct
+import sys
+import zlib
+from collections import OrderedDict
+from traceback import format_exc
+
+"""
+MIT License
+"""
+_epilog = """
+Extracts reads from a bin written with get_kaiju_otu.py --bgzf (or merged from
+such bins by finddups.py) without decompressing the rest of the file. The bin
+consists of BGZF blocks (small gzip members, as written by bgzip) and the
+index next to it (BIN.idx) lists the record number and the compressed offset
+of every block that starts with a record, for every sample in the bin. The
+records of a sample are numbered from 0, the mates of interleaved pairs are
+separate records.
+"""
+
+# maximum uncompressed size of a BGZF block
+BGZF_BLOCK_SIZE = 65280
+# empty BGZF block marking the end of a file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# file name extension of the index of a bin
+INDEX_SUFFIX = ".idx"
+INDEX_HEADER = "#sample\trecord\toffset\n"
+
+
+def bgzf_block(data, compresslevel):
+    """
+    Compresses data (at most BGZF_BLOCK_SIZE bytes) into a single BGZF block.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data) + compressor.flush()
+    # gzip header with the BC extra field holding the block size minus one
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<2I", zlib.crc32(data), len(data))
+
+
+def pack_bgzf(records, compresslevel):
+    """
+    Compresses records into BGZF blocks, starting a new block at a record whenever possible. Records larger than a
+    block are split over several blocks. Returns the blocks and the (record number, offset) of every block that
+    starts with a record, both relative to the first record.
+    """
+    blocks = []
+    index = []
+    offset = 0
+    chunk = []
+    chunksize = 0
+    chunkfirst = 0
+    for number, record in enumerate(records):
+        if chunk and chunksize + len(record) > BGZF_BLOCK_SIZE:
+            blocks.append(bgzf_block(b"".join(chunk), compresslevel))
+            index.append((chunkfirst, offset))
+            offset += len(blocks[-1])
+            chunk = []
+            chunksize = 0
+        if len(record) > BGZF_BLOCK_SIZE:
+            for start in range(0, len(record), BGZF_BLOCK_SIZE):
+                blocks.append(bgzf_block(record[start:start + BGZF_BLOCK_SIZE], compresslevel))
+                if start == 0:
+                    index.append((number, offset))
+                offset += len(blocks[-1])
+            continue
+        if not chunk:
+            chunkfirst = number
+        chunk.append(record)
+        chunksize += len(record)
+    if chunk:
+        blocks.append(bgzf_block(b"".join(chunk), compresslevel))
+        index.append((chunkfirst, offset))
+    return b"".join(blocks), index
+
+
+def write_index(idxfile, sample, index, records, end):
+    """
+    Writes the index of a bin holding the records of a single sample. The last entry holds the amount of records and
+    the offset at which they end.
+    """
+    with open(idxfile, "w") as fout:
+        fout.write(INDEX_HEADER)
+        for record, offset in index:
+            fout.write("%s\t%d\t%d\n" % (sample, record, offset))
+        fout.write("%s\t%d\t%d\n" % (sample, records, end))
+
+
+def read_index(idxfile, base=0):
+    """
+    Reads the index of a bin, adding base to all offsets.
+
+    {sample: [(record, offset)]}
+    """
+    index = OrderedDict()
+    with open(idxfile) as fin:
+        for line in fin:
+            if line.startswith("#"):
+                continue
+            sample, record, offset = line.rstrip("\n").split("\t")
+            index.setdefault(sample, []).append((int(record), int(offset) + base))
+    return index
+
+
+def merge_indices(idxfiles, sizes, idxfile):
+    """
+    Writes the index of the concatenation of bins, given the indices and sizes of the bins in concatenation order.
+    """
+    base = 0
+    with open(idxfile, "w") as fout:
+        fout.write(INDEX_HEADER)
+        for fname, size in zip(idxfiles, sizes):
+            for sample, entries in read_index(fname, base).items():
+                for record, offset in entries:
+                    fout.write("%s\t%d\t%d\n" % (sample, record, offset))
+            base += size
+
+
+def fetch_records(fqfile, sample=None, start=0, stop=None):
+    """
+    Yields the records start up to stop (exclusive) of a sample from an indexed bin, decompressing only from the
+    block holding the first requested record.
+    """
+    index = read_index(fqfile + INDEX_SUFFIX)
+    if sample is None:
+        if len(index) != 1:
+            raise ValueError("The bin %s holds %d samples, select one of: %s" % (fqfile, len(index), ", ".join(index)))
+        sample = next(iter(index))
+    if sample not in index:
+        raise KeyError("Sample %s is not in the bin %s" % (sample, fqfile))
+    entries = index[sample]
+    total = entries[-1][0]  # the last entry marks the end of the sample
+    stop = total if stop is None else min(stop, total)
+    if start >= stop:
+        return
+    first, offset = entries[bisect.bisect_right([record for record, _ in entries], start) - 1]
+    with open(fqfile, "rb") as fin:
+        fin.seek(offset)
+        with gzip.GzipFile(fileobj=fin, mode="rb") as records:
+            for number in range(first, stop):
+                record = b"".join(records.readline() for _ in range(4))
+                if not record:
+                    raise EOFError("The bin %s ended before record %d of sample %s" % (fqfile, number, sample))
+                if number >= start:
+                    yield record
+
+
+def main(args):
+    if not os.path.exists(args.bin):
+        raise FileNotFoundError("Bin %s does not exist." % args.bin)
+    if not os.path.exists(args.bin + INDEX_SUFFIX):
+        raise FileNotFoundError("Bin %s has no index (write the bins with get_kaiju_otu.py --bgzf)." % args.bin)
+    if args.list:
+        for sample, entries in read_index(args.bin + INDEX_SUFFIX).items():
+            print("%s\t%d" % (sample, entries[-1][0]))
+        return
+    out = sys.stdout.buffer
+    for record in fetch_records(args.bin, args.sample, args.start, args.stop):
+        out.write(record)
+    out.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Extracts reads from an indexed bin.",
+                                     epilog=_epilog)
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+    # Required arguments
+    required.add_argument("bin", help="The bin (gzipped FASTQ file with an index)", action="store", type=str)
+    # Optional arguments
+    optional.add_argument("-s", "--sample", help="The sample to extract reads of (required if the bin holds several)",
+                          type=str, action="store")
+    optional.add_argument("--start", help="Number of the first record to extract", type=int, action="store",
+                          default=0)
+    optional.add_argument("--stop", help="Number of the record to stop at (exclusive)", type=int, action="store")
+    optional.add_argument("--list", help="List the samples in the bin and their amount of records",
+                          action="store_true")
+    # Standard arguments
+    optional.add_argument("-v", "--verbose", help="Increase verbosity level", action="count")
+    optional.add_argument("-q", "--silent", help="Suppresses output messages, overriding the --verbose argument",
+                          action="store_true")
+    optional.add_argument("-l", "--log", help="Set the logging output location", action="store",
+                          type=argparse.FileType('w'), default=sys.stderr)
+    optional.add_argument("-V", "--version", action="version", version="1.0")
+    parser._action_groups.append(optional)
+    args = parser.parse_args()
+
+    loglvl = logging.WARNING
+    if args.silent:
+        loglvl = logging.ERROR
+    elif not args.verbose:
+        pass
+    elif args.verbose >= 2:
+        loglvl = logging.DEBUG
+    elif args.verbose == 1:
+        loglvl = logging.INFO
+    logging.basicConfig(format="[%(asctime)s] %(levelname)s: %(message)s", level=loglvl, stream=args.log)
+    logging.debug("Setting verbosity level to %s" % logging.getLevelName(loglvl))
+
+    exitcode = 0
+    try:
+        main(args)
+    except Exception as ex:
+        exitcode = 1
+        logging.error(ex)
+        logging.debug(format_exc())
+    finally:
+        logging.debug("Shutting down logging system ...")
+        logging.shutdown()
+    sys.exit(exitcode)
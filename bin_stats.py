@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+# local libraries
+import metrics
+
+"""
+MIT License
+"""
+
+
+# name of the statistics file in a directory of bins
+STATS_FILE = "binstats.tsv"
+STATS_HEADER = "#bin\treads\tbases\tmean_quality\tgc_fraction\tlengths\n"
+# offset of the quality scores in the FASTQ records (Sanger/Illumina 1.8+)
+PHRED_OFFSET = 33
+_GC = np.zeros(256, dtype=np.int64)
+_GC[list(b"GCgc")] = 1
+
+
+class BinStats(object):
+    """
+    Keeps the amount of reads and bases, the length histogram, the summed base quality and the amount of G and C
+    bases of every bin, computed over batches of records at once.
+
+    {(rank index, binname): [reads, bases, quality sum, GC bases, {length: reads}]}
+    """
+    def __init__(self):
+        self.bins = OrderedDict()
+
+    def add(self, otus, records):
+        """
+        Adds FASTQ records to the statistics of their bin at every rank (the OTU of the record).
+        """
+        with metrics.thread_stage("bin_statistics"):
+            self.count(otus, records)
+
+    def count(self, otus, records):
+        lines = [record.split(b"\n", 4) for record in records]
+        lengths = np.array([len(line[1]) for line in lines], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        seqs = np.frombuffer(b"".join(line[1] for line in lines), dtype=np.uint8)
+        quals = np.frombuffer(b"".join(line[3] for line in lines), dtype=np.uint8)
+        # per-record sums as differences of the running sums, which also handles empty reads
+        gc = np.concatenate(([0], np.cumsum(_GC[seqs])))
+        qual = np.concatenate(([0], np.cumsum(quals, dtype=np.int64)))
+        gc = gc[ends] - gc[starts]
+        qual = qual[ends] - qual[starts] - PHRED_OFFSET * lengths
+        span = int(lengths.max()) + 1 if len(lengths) else 1
+        for rank in range(len(otus[0]) if otus else 0):
+            binnames, binidx = np.unique(np.array([otu[rank] for otu in otus], dtype=object), return_inverse=True)
+            reads = np.bincount(binidx, minlength=len(binnames))
+            bases = np.bincount(binidx, lengths, len(binnames))
+            quality = np.bincount(binidx, qual, len(binnames))
+            gcbases = np.bincount(binidx, gc, len(binnames))
+            pairs, counts = np.unique(binidx * span + lengths, return_counts=True)
+            for idx, binname in enumerate(binnames.tolist()):
+                stats = self.bins.get((rank, binname))
+                if stats is None:
+                    stats = self.bins[(rank, binname)] = [0, 0, 0, 0, Counter()]
+                stats[0] += int(reads[idx])
+                stats[1] += int(bases[idx])
+                stats[2] += int(quality[idx])
+                stats[3] += int(gcbases[idx])
+            for pair, count in zip(pairs.tolist(), counts.tolist()):
+                idx, length = divmod(pair, span)
+                self.bins[(rank, binnames[idx])][4][length] += count
+
+
+def format_stats(binname, stats):
+    reads, bases, quality, gcbases, lengths = stats
+    return "%s\t%d\t%d\t%.4f\t%.6f\t%s\n" % (binname, reads, bases, quality / bases if bases else 0.0,
+                                             gcbases / bases if bases else 0.0,
+                                             ",".join("%d:%d" % item for item in sorted(lengths.items())))
+
+
+def write_stats(statsfile, bins):
+    """
+    Writes the statistics of the bins ({binname: stats}) to a TSV file. The length histogram is written as a comma
+    separated list of length:reads.
+    """
+    with open(statsfile, "w") as fout:
+        fout.write(STATS_HEADER)
+        for binname, stats in bins.items():
+            fout.write(format_stats(binname, stats))
+
+
+def read_stats(statsfile):
+    """
+    Reads the statistics of the bins from a TSV file. The summed quality and GC bases are recovered from the means.
+
+    {binname: stats}
+    """
+    bins = OrderedDict()
+    with open(statsfile) as fin:
+        for line in fin:
+            if line.startswith("#"):
+                continue
+            binname, reads, bases, quality, gcfraction, lengths = line.rstrip("\n").split("\t")
+            bases = int(bases)
+            bins[binname] = [int(reads), bases, round(float(quality) * bases), round(float(gcfraction) * bases),
+                             Counter({int(length): int(count) for length, count in
+                                      (item.split(":") for item in lengths.split(",") if item)})]
+    return bins
+
+
+def merge_stats(statsfiles, statsfile):
+    """
+    Writes the statistics of the bins of several samples, adding up the statistics of bins with the same name.
+    """
+    merged = OrderedDict()
+    for fname in statsfiles:
+        for binname, stats in read_stats(fname).items():
+            total = merged.setdefault(binname, [0, 0, 0, 0, Counter()])
+            for idx in range(4):
+                total[idx] += stats[idx]
+            total[4].update(stats[4])
+    write_stats(statsfile, merged)
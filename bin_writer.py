@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import gzip
+import os
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+# local libraries
+import bin_index
+import metrics
+
+"""
+MIT License
+"""
+
+
+# uncompressed size of a single gzip member
+BLOCK_SIZE = 4 * 1024 * 1024
+# maximum amount of simultaneously opened bin files
+MAX_OPEN = 64
+# maximum amount of uncompressed data buffered over all bins
+MAX_MEMORY = 512 * 1024 * 1024
+
+
+def compress_records(records, compresslevel, bgzf=False):
+    """
+    Compresses a list of records into a single gzip member, or into BGZF blocks. Returns the compressed data and the
+    BGZF block index relative to the first record (None for a gzip member).
+    """
+    if bgzf:
+        return bin_index.pack_bgzf(records, compresslevel)
+    return gzip.compress(b"".join(records), compresslevel), None
+
+
+class BinWriter(object):
+    """ Output file of a single bin, buffering records until the pool compresses them """
+    def __init__(self, pool, filename):
+        self.pool = pool
+        self.filename = filename
+        self.buffer = []
+        self.buffered = 0
+        # totals of the bin, for the metrics of the run
+        self.records = 0
+        self.written = 0
+        self.compressed = 0
+        # (record number, offset) of the BGZF blocks starting with a record
+        self.index = []
+
+    def write(self, data):
+        self.records += 1
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.pool.buffered += len(data)
+        if self.buffered >= self.pool.blocksize:
+            self.pool.submit(self)
+        elif self.pool.buffered > self.pool.max_memory:
+            self.pool.evict()
+
+
+class BinWriterPool(object):
+    """
+    Writes the bins as series of independently compressed gzip members, which concatenate into a valid gzip file.
+    Members are compressed on a thread pool (zlib releases the GIL) and appended to the bin files through a fixed
+    size LRU pool of file handles, so the amount of bins is not limited by the amount of open file descriptors.
+    Records of bins that are written to rarely are kept in memory until either their buffer reaches the block size or
+    the memory budget of all buffers is exceeded.
+
+    Given a sample name, the members are written as BGZF blocks instead and an index of the record numbers and
+    offsets of the blocks is written next to every bin when the pool is closed (see bin_index).
+    """
+    def __init__(self, workers=1, compresslevel=4, blocksize=BLOCK_SIZE, max_open=MAX_OPEN, max_memory=MAX_MEMORY,
+                 index_sample=None):
+        self.executor = ThreadPoolExecutor(max(1, workers))
+        self.compresslevel = compresslevel
+        self.index_sample = index_sample
+        self.blocksize = blocksize
+        self.max_open = max(1, max_open)
+        self.max_memory = max_memory
+        self.max_pending = 2 * max(1, workers)
+        self.writers = []
+        self.restored = {}
+        self.handles = OrderedDict()
+        self.pending = deque()
+        self.buffered = 0
+
+    def open(self, filename):
+        """ Creates (or truncates) the file of a bin and returns its writer, unless the bin was restored """
+        if filename in self.restored:
+            return self.restored.pop(filename)
+        open(filename, "wb").close()
+        writer = BinWriter(self, filename)
+        self.writers.append(writer)
+        return writer
+
+    def submit(self, writer):
+        """ Hands the buffer of the given bin to the compression threads as a single gzip member """
+        if writer.buffered > 0:
+            first = writer.records - len(writer.buffer)
+            self.pending.append((writer, self.executor.submit(self._compress, writer.buffer), first))
+            self.buffered -= writer.buffered
+            writer.written += writer.buffered
+            writer.buffer = []
+            writer.buffered = 0
+        self._write_finished()
+
+    def _compress(self, records):
+        with metrics.thread_stage("compression"):
+            return compress_records(records, self.compresslevel, self.index_sample is not None)
+
+    def write_member(self, writer, member, records=0, size=0, index=None):
+        """
+        Appends an already compressed gzip member (or BGZF blocks with their index) to the given bin, after the records
+        buffered so far. The amount of records is needed to number the records of the index, the uncompressed size is
+        only used for the metrics.
+        """
+        self.submit(writer)
+        first = writer.records
+        writer.records += records
+        writer.written += size
+        future = Future()
+        future.set_result((member, index))
+        self.pending.append((writer, future, first))
+        self._write_finished()
+
+    def _write_finished(self):
+        # members are written in submission order, which keeps the members of every bin in order
+        while self.pending and (self.pending[0][1].done() or len(self.pending) > self.max_pending):
+            self._write_member(*self.pending.popleft())
+
+    def _write_member(self, writer, member, first):
+        member, index = member.result()
+        if index is not None:
+            writer.index.extend((first + record, writer.compressed + offset) for record, offset in index)
+        writer.compressed += len(member)
+        self.get_handle(writer.filename).write(member)
+
+    def evict(self):
+        """ Compresses the largest buffers until at most half of the memory budget is in use """
+        for writer in sorted(self.writers, key=lambda x: x.buffered, reverse=True):
+            if self.buffered <= self.max_memory // 2:
+                break
+            self.submit(writer)
+
+    def get_handle(self, filename):
+        """ Returns an opened handle of the given file, closing the least recently used handle if needed """
+        fhandle = self.handles.get(filename)
+        if fhandle is not None:
+            self.handles.move_to_end(filename)
+            return fhandle
+        if len(self.handles) >= self.max_open:
+            self.handles.popitem(last=False)[1].close()
+        fhandle = self.handles[filename] = open(filename, "ab")
+        return fhandle
+
+    def flush(self):
+        """ Compresses and writes everything that was written so far """
+        for writer in self.writers:
+            self.submit(writer)
+        while self.pending:
+            self._write_member(*self.pending.popleft())
+        for fhandle in self.handles.values():
+            fhandle.flush()
+
+    def state(self):
+        """
+        Returns the length and totals of every bin. Only consistent right after a flush.
+        """
+        return [OrderedDict([("filename", writer.filename), ("compressed", writer.compressed),
+                             ("records", writer.records), ("written", writer.written), ("index", writer.index)])
+                for writer in self.writers]
+
+    def restore(self, states):
+        """
+        Continues the bins of an earlier state: the files are truncated to their length in the state, anything
+        written after it is dropped.
+        """
+        for state in states:
+            if os.path.getsize(state["filename"]) < state["compressed"]:
+                raise ValueError("The bin %s is shorter than in the checkpoint." % state["filename"])
+            os.truncate(state["filename"], state["compressed"])
+            writer = BinWriter(self, state["filename"])
+            writer.compressed = state["compressed"]
+            writer.records = state["records"]
+            writer.written = state["written"]
+            writer.index = [tuple(entry) for entry in state["index"]]
+            self.writers.append(writer)
+            self.restored[writer.filename] = writer
+
+    def stats(self):
+        """
+        Returns the amount of records, uncompressed bytes and compressed bytes written to every bin so far.
+
+        {filename: {"records": int, "bytes": int, "compressed_bytes": int}}
+        """
+        return OrderedDict((writer.filename, OrderedDict([("records", writer.records), ("bytes", writer.written),
+                                                          ("compressed_bytes", writer.compressed)]))
+                           for writer in self.writers)
+
+    def write_indices(self):
+        """ Ends every bin with the BGZF end-of-file marker and writes its index """
+        for writer in self.writers:
+            end = writer.compressed
+            self.get_handle(writer.filename).write(bin_index.BGZF_EOF)
+            writer.compressed += len(bin_index.BGZF_EOF)
+            bin_index.write_index(writer.filename + bin_index.INDEX_SUFFIX, self.index_sample, writer.index,
+                                  writer.records, end)
+
+    def close(self):
+        try:
+            self.flush()
+            if self.index_sample is not None:
+                self.write_indices()
+        finally:
+            for fhandle in self.handles.values():
+                fhandle.close()
+            self.handles.clear()
+            self.executor.shutdown()
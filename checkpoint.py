@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+"""
+MIT License
+"""
+
+
+# version of the checkpoint layout
+CHECKPOINT_VERSION = 1
+# bytes hashed at the start and the end of every input file
+FINGERPRINT_BYTES = 1024 * 1024
+
+
+def fingerprint(files, options):
+    """
+    Returns a checksum of the input files and the options that determine the contents of the bins. A file is
+    identified by its path, size, modification time and its first and last FINGERPRINT_BYTES bytes, so it does not
+    have to be read completely.
+    """
+    checksum = hashlib.sha1(json.dumps(options, sort_keys=True).encode())
+    for fname in files:
+        fstat = os.stat(fname)
+        checksum.update(("%s\t%d\t%d\n" % (os.path.realpath(fname), fstat.st_size, fstat.st_mtime_ns)).encode())
+        with open(fname, "rb") as fin:
+            checksum.update(fin.read(FINGERPRINT_BYTES))
+            fin.seek(max(0, fstat.st_size - FINGERPRINT_BYTES))
+            checksum.update(fin.read(FINGERPRINT_BYTES))
+    return checksum.hexdigest()
+
+
+class Checkpoint(object):
+    """
+    Periodically records how many input records (and uncompressed input bytes) were binned, together with the length
+    of every bin after flushing all complete gzip members. A new run with the same fingerprint truncates the bins to
+    these lengths and resumes after the recorded input records. The checkpoint file is replaced atomically. The
+    BinWriterPool of the bins has to be set (writers) before resuming or advancing.
+    """
+    def __init__(self, filename, fingerprint, interval, writers=None):
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.writers = writers
+        self.records = 0
+        self.input_bytes = 0
+        self.unsaved = 0
+
+    def load(self):
+        """
+        Returns the saved state if it belongs to the same input and options, None otherwise.
+        """
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename) as fin:
+                state = json.load(fin)
+        except ValueError:
+            logging.warning("Ignoring unreadable checkpoint %s" % self.filename)
+            return None
+        if state.get("version") != CHECKPOINT_VERSION or state.get("fingerprint") != self.fingerprint:
+            logging.info("Checkpoint %s belongs to other input files or options; starting from scratch" % self.filename)
+            return None
+        return state
+
+    def resume(self, state):
+        """ Restores the bins of the given state and continues counting from it """
+        logging.info("Resuming after %d records (%d bins) from checkpoint %s"
+                     % (state["records"], len(state["bins"]), self.filename))
+        self.writers.restore(state["bins"])
+        self.records = state["records"]
+        self.input_bytes = state["input_bytes"]
+
+    def advance(self, records, nbytes):
+        """ Registers binned input records, saving a checkpoint every interval bytes """
+        self.records += records
+        self.input_bytes += nbytes
+        self.unsaved += nbytes
+        if self.unsaved >= self.interval:
+            self.save()
+
+    def save(self, complete=False):
+        """ Flushes the bins and atomically replaces the checkpoint file """
+        if not complete:
+            self.writers.flush()
+        state = OrderedDict([("version", CHECKPOINT_VERSION), ("fingerprint", self.fingerprint),
+                             ("complete", complete), ("records", self.records), ("input_bytes", self.input_bytes),
+                             ("bins", self.writers.state())])
+        tmpfile = self.filename + ".tmp"
+        with open(tmpfile, "w") as fout:
+            json.dump(state, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(tmpfile, self.filename)
+        self.unsaved = 0
+        logging.debug("Checkpoint after %d records written to %s" % (self.records, self.filename))
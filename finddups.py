@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
+import errno
 import os
+import shutil
+import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+# local libraries
+import bin_index
+import bin_stats
 
 """
 MIT License
@@ -11,11 +19,17 @@ Author: Thom Griffioen <t.griffioen@nioo.knaw.nl>
 Date: 2017-05-11
 
 
-Usage: finddups.py SEARCHDIR [SEARCHDIR2 ...] OUTDIR
+Usage: finddups.py [--threads N] SEARCHDIR [SEARCHDIR2 ...] OUTDIR
 """
 
 
-def main(args):
+# chunk size of the userspace fallback copy
+CHUNK_SIZE = 1024 * 1024
+# errors of copy_file_range/sendfile meaning the call is not supported for the given files
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+
+def main(args, threads=1):
     dirs = args[:-1]
     outdir = args[-1]
     for dir in dirs:
@@ -25,23 +39,102 @@ def main(args):
     if not os.access(outdir, os.W_OK):
         raise PermissionError("Writing to the output directory %s is not permitted." % outdir)
 
-    fileoccurences = {}
+    # {output file: [input files]}, in the order of the search directories. Bins in subdirectories (e.g. one per
+    # taxonomic rank) are merged into the same subdirectory of the output directory.
+    fileoccurences = OrderedDict()
+    statsfiles = []
     for dir in dirs:
         for root, directories, files in os.walk(dir):
-            for fname in files:
+            directories.sort()
+            for fname in sorted(files):
+                if fname.endswith(".fq.gz" + bin_index.INDEX_SUFFIX):
+                    continue  # merged along with its bin
+                if fname == bin_stats.STATS_FILE and root == dir:
+                    statsfiles.append(os.path.join(root, fname))
+                    continue
                 if not fname.endswith(".fq.gz"):
                     print("Skipping %s ... (not a gzipped FASTQ file)" % fname, file=sys.stderr)
                     continue
                 fpath = os.path.join(root, fname)
-                fileoccurences[fname] = fileoccurences.get(fname, 0) + 1
-                fout = os.path.join(outdir, fname)
-                print("Appending %s to %s (contains reads from %d bins) ..." % (fpath, fout, fileoccurences[fname]), file=sys.stderr)
-                if os.path.exists(fout) and fileoccurences[fname] <= 1:
-                    raise FileExistsError("The output file %s already exists." % fpath)
-                # append/create output file
-                with open(fpath, "rb") as fin, open(fout, "a+b") as fout:
-                    fout.write(fin.read())
+                fout = os.path.join(outdir, os.path.relpath(fpath, dir))
+                fileoccurences.setdefault(fout, []).append(fpath)
+    for fout in fileoccurences:
+        if os.path.exists(fout):
+            raise FileExistsError("The output file %s already exists." % fout)
+    statsout = os.path.join(outdir, bin_stats.STATS_FILE)
+    if statsfiles and os.path.exists(statsout):
+        raise FileExistsError("The output file %s already exists." % statsout)
+
+    # merge different bins concurrently, the files of a single bin are appended in order
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        for fout in pool.map(merge_files, fileoccurences.items()):
+            print("Merged %d files into %s" % (len(fileoccurences[fout]), fout), file=sys.stderr)
+    # the statistics of the bins add up like the bins themselves
+    if statsfiles:
+        bin_stats.merge_stats(statsfiles, statsout)
+        print("Merged %d bin statistics into %s" % (len(statsfiles), statsout), file=sys.stderr)
+
+
+def merge_files(item):
+    """
+    Concatenates the input files into the output file. Returns the output file. If all input files are indexed
+    bins, the indices are merged as well.
+    """
+    fout, fpaths = item
+    os.makedirs(os.path.dirname(fout), exist_ok=True)
+    sizes = []
+    with open(fout, "wb", buffering=0) as dst:
+        for fpath in fpaths:
+            print("Appending %s to %s ..." % (fpath, fout), file=sys.stderr)
+            with open(fpath, "rb", buffering=0) as src:
+                sizes.append(os.fstat(src.fileno()).st_size)
+                append_file(src, dst)
+    idxfiles = [fpath + bin_index.INDEX_SUFFIX for fpath in fpaths]
+    indexed = [os.path.exists(idxfile) for idxfile in idxfiles]
+    if all(indexed):
+        bin_index.merge_indices(idxfiles, sizes, fout + bin_index.INDEX_SUFFIX)
+    elif any(indexed):
+        print("Not indexing %s, some of its input files have no index" % fout, file=sys.stderr)
+    return fout
+
+
+def append_file(src, dst):
+    """
+    Copies the rest of src to dst. The data is copied by the kernel (copy_file_range or sendfile) if possible and
+    in fixed size chunks otherwise, so the file is never loaded into memory.
+    """
+    remaining = os.fstat(src.fileno()).st_size - src.tell()
+    kernel_copies = []
+    if hasattr(os, "copy_file_range"):
+        kernel_copies.append(lambda count: os.copy_file_range(src.fileno(), dst.fileno(), count))
+    if hasattr(os, "sendfile"):
+        kernel_copies.append(lambda count: os.sendfile(dst.fileno(), src.fileno(), None, count))
+    for kernel_copy in kernel_copies:
+        try:
+            while remaining > 0:
+                copied = kernel_copy(min(remaining, 1024 * CHUNK_SIZE))
+                if copied == 0:
+                    break  # some filesystems stop early, the rest is copied another way
+                remaining -= copied
+        except OSError as ex:
+            if ex.errno not in _UNSUPPORTED:
+                raise
+        if remaining == 0:
+            return
+    # the kernel copies advance the file offsets, so this continues where they stopped
+    start = dst.tell()
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    if dst.tell() - start < remaining:
+        raise EOFError("%s ended %d bytes early while appending it to %s"
+                       % (src.name, remaining - (dst.tell() - start), dst.name))
 
 
 if __name__ == '__main__':
-    main(sys.argv[1:])
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Merges bins with the same name.")
+    parser.add_argument("dirs", help="Directories with bins, followed by the output directory", nargs="+",
+                        metavar="DIR")
+    parser.add_argument("--threads", help="Number of bins merged at the same time", type=int, default=1)
+    args = parser.parse_args()
+    if len(args.dirs) < 2:
+        parser.error("at least one search directory and the output directory are required")
+    main(args.dirs, args.threads)
@@ -2,11 +2,15 @@
 
 # standard libraries
 import argparse
+import bz2
+import json
 import logging
 import os
 import re
 import sys
+import zlib
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from traceback import format_exc
 # PyYAML
 import yaml
@@ -27,9 +31,20 @@ Generate configuration files in YAML format of your NGS samples. To be used in
 the Snakemake pipeline. This program expects paired samples. The filename of a
 pair should be the same except for the '_R1'/'_R2' part (or '_1'/'_2'). The ID
 of the pair will be the rest of the filename (i.e. test_r1.fq.gz will get the
-ID 'test').
+ID 'test'). The directories are listed concurrently (--threads) and the
+listings are cached together with the modification time of every directory
+(--scan-cache). When the configuration file already exists, only directories
+that changed since the last run are listed again and the new files are merged
+into the existing configuration, unless --rebuild is given. The size and the
+estimated amount of reads of every sample are written to the 'sizes' entry,
+which the pipeline uses to scale the threads, disk IO and memory of its rules.
 """
 
+# version of the scan cache layout
+SCAN_CACHE_VERSION = 2
+# compressed bytes read from the start of a file to estimate its amount of reads
+ESTIMATE_BYTES = 4 * 1024 * 1024
+
 
 # Adapted from: https://github.com/pnnl/atlas/blob/master/atlas/conf.py
 # http://stackoverflow.com/a/3675423
@@ -41,7 +56,60 @@ def replace_last(source_string, replace_what, replace_with):
         return head + replace_with + tail
 
 
-def get_sample_files(path):
+def scan_dir(dirpath, cached=None):
+    """
+    Lists the files and subdirectories of a directory. The cached listing is returned if the modification time of the
+    directory did not change since it was made.
+
+    {"mtime": int, "files": [file names], "dirs": [directory names]}
+    """
+    mtime = os.stat(dirpath).st_mtime_ns
+    if cached is not None and cached["mtime"] == mtime:
+        return cached
+    files = []
+    dirs = []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                files.append(entry.name)
+            elif not entry.is_symlink():  # like os.walk, symbolic links to directories are not followed
+                dirs.append(entry.name)
+    return {"mtime": mtime, "files": sorted(files), "dirs": sorted(dirs)}
+
+
+def scan_tree(path, threads=1, cache=None):
+    """
+    Lists the files of all directories below path, listing the directories of every level concurrently. Directories
+    found in the cache ({directory: listing}) are only listed again if they were modified. The cache is replaced by
+    the listings of this scan.
+
+    {directory: [file names]}
+    """
+    cache = {} if cache is None else cache
+    cached = dict(cache)
+    cache.clear()
+    tree = OrderedDict()
+    rescanned = 0
+    level = [path]
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        while level:
+            nextlevel = []
+            for dirpath, listing in zip(level, pool.map(lambda x: scan_dir(x, cached.get(x)), level)):
+                if listing is not cached.get(dirpath):
+                    rescanned += 1
+                cache[dirpath] = listing
+                tree[dirpath] = listing["files"]
+                nextlevel.extend(os.path.join(dirpath, dname) for dname in listing["dirs"])
+            level = nextlevel
+    logging.debug("Listed %d of %d directories (others unchanged since the last scan)" % (rescanned, len(tree)))
+    return tree
+
+
+def get_sample_files(path, threads=1, cache=None):
+    """
+    Finds the read pairs below path and groups them by sample. The directory listings in cache are reused for the
+    directories that were not modified, and cache is updated with the listings of this scan.
+    """
     path = os.path.realpath(path)
     # set valid file extensions
     valid_formats = [".fastq", ".fq"]
@@ -56,10 +124,7 @@ def get_sample_files(path):
     samples = OrderedDict()
     seen = set()
     compress_algo = []
-    for dir_name, sub_dirs, files in os.walk(path):
-        logging.debug("dir_name: %s" % dir_name)
-        logging.debug("sub_dirs: %s" % sub_dirs)
-        logging.debug("files:    %s" % files)
+    for dir_name, files in scan_tree(path, threads, cache).items():
         for fname in files:
             if not fname.endswith(valid_ext):
                 logging.info("File %s does not have a valid extension." % fname)
@@ -128,20 +193,136 @@ def get_sample_files(path):
     return samples, str(compress_algo[0])[1:]
 
 
-def make_config(config, dataloc):
+def merge_samples(existing, samples):
+    """
+    Merges newly found samples into the samples of an earlier configuration. The read pairs that were already
+    listed keep their order, new pairs are appended and pairs of which a file no longer exists are dropped.
+    """
+    merged = OrderedDict()
+    for sample_id, files in list(existing.items()) + list(samples.items()):
+        pairs = merged.setdefault(sample_id, [])
+        for pair in zip(files.get("r1", []), files.get("r2", [])):
+            if pair in pairs:
+                continue
+            if not all(os.path.exists(fpath) for fpath in pair):
+                logging.warning("Dropping read pair %s + %s of sample %s (file does not exist)" % (pair + (sample_id,)))
+                continue
+            pairs.append(pair)
+    return OrderedDict(natsorted((sample_id, OrderedDict([("r1", [r1 for r1, r2 in pairs]),
+                                                          ("r2", [r2 for r1, r2 in pairs])]))
+                                 for sample_id, pairs in merged.items() if pairs))
+
+
+def estimate_reads(fpath):
+    """
+    Estimates the amount of reads in a (compressed) FASTQ file from the reads in the first ESTIMATE_BYTES bytes of
+    the file, so the file does not have to be decompressed completely.
+    """
+    size = os.path.getsize(fpath)
+    with open(fpath, "rb") as fin:
+        head = fin.read(ESTIMATE_BYTES)
+    if fpath.endswith(".gz"):
+        new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif fpath.endswith(".bz2"):
+        new_decompressor = bz2.BZ2Decompressor
+    else:
+        return int(size * head.count(b"\n") / 4 / max(1, len(head)))
+    lines = 0
+    data = head
+    while data:  # the file may consist of multiple compressed streams
+        decompressor = new_decompressor()
+        lines += decompressor.decompress(data).count(b"\n")
+        data = decompressor.unused_data if decompressor.eof else b""
+    return int(size * lines / 4 / max(1, len(head)))
+
+
+def get_sample_sizes(samples, threads=1, cache=None):
+    """
+    Returns the total size and the estimated amount of reads (of both directions) of every sample. Estimates in the
+    cache ({file: [size, mtime, reads]}) are reused for files that did not change, and cache is updated.
+
+    {sample: {"bytes": int, "reads": int}}
+    """
+    cache = {} if cache is None else cache
+    cached = dict(cache)
+    cache.clear()
+
+    def estimate(fpath):
+        stat = os.stat(fpath)
+        entry = cached.get(fpath)
+        if entry is None or entry[:2] != [stat.st_size, stat.st_mtime_ns]:
+            entry = [stat.st_size, stat.st_mtime_ns, estimate_reads(fpath)]
+        return fpath, entry
+
+    fpaths = [fpath for files in samples.values() for direction in ("r1", "r2") for fpath in files[direction]]
+    with ThreadPoolExecutor(max(1, threads)) as pool:
+        cache.update(pool.map(estimate, fpaths))
+    sizes = OrderedDict()
+    for sample_id, files in samples.items():
+        fpaths = files["r1"] + files["r2"]
+        sizes[sample_id] = OrderedDict([("bytes", sum(cache[fpath][0] for fpath in fpaths)),
+                                        ("reads", sum(cache[fpath][2] for fpath in fpaths))])
+        logging.debug("Sample %s: %d bytes, about %d reads" % (sample_id, sizes[sample_id]["bytes"],
+                                                              sizes[sample_id]["reads"]))
+    return sizes
+
+
+def load_scan_cache(cachefile, dataloc):
+    """
+    Returns the cached directory listings and read estimates of an earlier scan of dataloc, or an empty cache.
+
+    {"directories": {directory: listing}, "estimates": {file: [size, mtime, reads]}}
+    """
+    empty = {"directories": {}, "estimates": {}}
+    if not cachefile or not os.path.exists(cachefile):
+        return empty
+    try:
+        with open(cachefile) as fin:
+            cache = json.load(fin)
+    except ValueError:
+        logging.warning("Ignoring unreadable scan cache %s" % cachefile)
+        return empty
+    if cache.get("version") != SCAN_CACHE_VERSION or cache.get("root") != os.path.realpath(dataloc):
+        logging.info("Scan cache %s does not belong to %s; rescanning everything" % (cachefile, dataloc))
+        return empty
+    return cache
+
+
+def make_config(config, dataloc, threads=1, cachefile=None, rebuild=False):
     """Write the file 'config' and complete the sample names and paths for all files in 'path'."""
     represent_dict_order = lambda self, data: self.represent_mapping('tag:yaml.org,2002:map', data.items())
     yaml.add_representer(OrderedDict, represent_dict_order)
     conf = OrderedDict()
-    samples, compressmethod = get_sample_files(dataloc)
+    if not rebuild and os.path.exists(config):
+        logging.info("Merging with the existing config %s ..." % config)
+        with open(config) as f:
+            conf.update(yaml.safe_load(f) or {})
+        if conf.get("root") != os.path.realpath(dataloc):
+            # the samples of another tree would survive the merge
+            logging.info("The existing config %s does not belong to %s; ignoring its samples" % (config, dataloc))
+            for key in ("compression", "root", "data", "sizes"):
+                conf.pop(key, None)
+    cache = load_scan_cache(None if rebuild else cachefile, dataloc)
+    samples, compressmethod = get_sample_files(dataloc, threads, cache["directories"])
     logging.info("Found %d samples under %s" % (len(samples), dataloc))
     logging.info("Compression method detected: %s" % compressmethod)
+    if conf.get("compression", compressmethod) != compressmethod:
+        raise Exception("The new files are compressed with '%s', the existing config uses '%s'. This is not "
+                        "supported." % (compressmethod, conf["compression"]))
     conf["compression"] = compressmethod
-    conf["data"] = samples
+    conf["root"] = os.path.realpath(dataloc)
+    conf["data"] = merge_samples(conf.get("data") or {}, samples)
+    logging.info("Estimating the size of %d samples ..." % len(conf["data"]))
+    conf["sizes"] = get_sample_sizes(conf["data"], threads, cache["estimates"])
     with open(config, "w") as f:
         logging.info("Writing config to %s ..." % config)
         f.write(yaml.dump(conf, default_flow_style=False))
     logging.info("Configuration file written to %s" % config)
+    if cachefile:
+        with open(cachefile, "w") as f:
+            json.dump({"version": SCAN_CACHE_VERSION, "root": os.path.realpath(dataloc),
+                       "directories": cache["directories"], "estimates": cache["estimates"]}, f)
+        logging.debug("Scan cache written to %s" % cachefile)
 
 
 if __name__ == "__main__":
@@ -151,6 +332,14 @@ if __name__ == "__main__":
     # Required arguments
     required.add_argument("SAMPLES", help="The location of your NGS samples", action="store")
     required.add_argument("CONFIGFILE", help="The name of the generated configuration file", action="store")
+    # Optional arguments
+    optional.add_argument("-t", "--threads", help="Number of directories listed (and files sampled) at the same time",
+                          type=int, action="store", default=8)
+    optional.add_argument("-c", "--scan-cache", help="Cache of the directory listings (default: CONFIGFILE.scan.json)",
+                          type=str, action="store")
+    optional.add_argument("-r", "--rebuild",
+                          help="Ignore the existing configuration file and scan cache and rescan everything",
+                          action="store_true")
     # Standard arguments
     optional.add_argument("-v", "--verbose", help="Increase verbosity level", action="count")
     optional.add_argument("-q", "--silent", help="Suppresses output messages, overriding the --verbose argument",
@@ -175,7 +364,8 @@ if __name__ == "__main__":
 
     exitcode = 0
     try:
-        make_config(config=args.CONFIGFILE, dataloc=args.SAMPLES)
+        make_config(config=args.CONFIGFILE, dataloc=args.SAMPLES, threads=args.threads,
+                    cachefile=args.scan_cache or args.CONFIGFILE + ".scan.json", rebuild=args.rebuild)
     except Exception as ex:
         exitcode = 1
         logging.error(ex)
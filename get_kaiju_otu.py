@@ -2,17 +2,34 @@
 
 # standard libraries
 import argparse
-import gzip
+import cProfile
+import io
 import logging
+import multiprocessing
 import os
+import pstats
+import queue
 import re
+import shutil
+import stat
+import subprocess
 import sys
+import threading
+import time
+import zlib
+from collections import defaultdict, deque, OrderedDict
+from contextlib import contextmanager
+from itertools import islice, zip_longest
 from traceback import format_exc
-# biopython and etetoolkit
-from Bio import SeqIO
-from ete3 import NCBITaxa
 # local libraries
+import bin_index
+import bin_stats
+import bin_writer
+import checkpoint
+import kmer_hist
 import lineage_lookup
+import metrics
+import read_store
 
 """
 MIT License
@@ -25,51 +42,419 @@ _epilog = """
 This program parses the results from Kaiju and attempts to bin the reads. It
 splits based on the taxonomic rank. Processing paired-end reads should not be
 a problem as long as the reads are ordered (i.e. the first and second read are
-a pair, the third and fourth the second pair, etc.). Please make sure that the
-amount of bins created will not exceed the systems limit (shown by ulimit -n).
-You can increase this limit with ulimit -n VALUE, with the maximum value being
-the value of ulimit -Hn.
+a pair, the third and fourth the second pair, etc.). The mates may also be
+given as two files (--input and --input2), which are read in lockstep; the
+mates are then written interleaved, or to separate _R1 and _R2 files per bin
+with --split-mates. At most --max-open-files bin files are open at the same
+time and the records of the other bins are buffered in memory (up to
+--buffer-memory MB in total), so any amount of bins can be written without
+raising the open file limit (ulimit -n). With --stream, the Kaiju output is
+not loaded into memory but read alongside the FASTQ file, which requires the
+Kaiju output to be in the same order as the reads (as written by Kaiju
+itself). The Kaiju output may also be read from a pipe (--kaiju -) or a named
+pipe, e.g. straight from a running Kaiju; the reads are then always binned as
+the classifications arrive (--stream). With --metrics, the time spent in every
+stage, the throughput, the lineage cache hit rate, the records and bytes of
+every bin and the peak memory use are written to a JSON file. With
+--kmer-hist, the k-mers of the reads are counted while binning and their depth
+histogram (as written by BBMap khist.sh) is written for the whole sample and
+for every bin, next to the bin. With --bin-stats, the amount of reads and
+bases, the mean base quality, the GC fraction and the read length histogram of
+every bin are written to binstats.tsv in the output directory, which
+finddups.py merges along with the bins. The FASTQ files are decompressed by
+pigz if it is installed (see --decompressor), ahead of the parsing in a
+separate thread (--read-ahead), while the bins are compressed by
+--compress-threads threads, so reading, parsing and writing overlap.
 """
 
+# amount of read IDs looked up at once (even, so a checkpoint never falls between the mates of a pair)
+LOOKUP_BATCH = 16384
+# amount of decompressed FASTQ data buffered by the reader
+READ_BUFFER = 1024 * 1024
+# default amount of decompressed input (in MB) read ahead of the parser
+READ_AHEAD = 64
+
+# how the FASTQ files are decompressed, set from the command line: blocks of READ_BUFFER bytes decompressed ahead of
+# the parser (0 reads in the parsing thread) and the pigz executable (None decompresses with zlib)
+_read_ahead = READ_AHEAD
+_pigz = None
+
 
 def main(args):
+    global _read_ahead, _pigz
     if not os.path.exists(args.input):
         raise FileNotFoundError("FASTQ file %s does not exist." % args.input)
-    if not os.path.exists(args.kaiju):
+    if args.input2 and not os.path.exists(args.input2):
+        raise FileNotFoundError("FASTQ file %s does not exist." % args.input2)
+    if args.split_mates and not args.input2:
+        raise ValueError("Writing the mates to separate files (--split-mates) requires --input2.")
+    if args.kaiju != "-" and not os.path.exists(args.kaiju):
         raise FileNotFoundError("Kaiju result file %s does not exist." % args.kaiju)
-    if args.taxon_rank not in lineage_lookup.tax_ranks:
-        raise ArgumentError("The given rank '%s' is not supported." % args.taxon_rank)
+    if is_pipe(args.kaiju) and not args.stream:
+        logging.info("Reading the Kaiju output from a pipe, binning reads as they are classified (--stream)")
+        args.stream = True
+    if args.taxonomy_index and not os.path.isdir(args.taxonomy_index):
+        raise FileNotFoundError("Taxonomy index %s does not exist." % args.taxonomy_index)
+    taxranks = get_taxon_ranks(args.taxon_rank)
+    if args.stream and args.shards > 1:
+        raise ValueError("Sharded binning (--shards) can not be combined with --stream or a piped Kaiju output.")
+    if args.input2 and args.shards > 1:
+        raise ValueError("Sharded binning (--shards) requires a single (interleaved) FASTQ file instead of --input2.")
+    _read_ahead = args.read_ahead * 1024 * 1024 // READ_BUFFER
+    _pigz = None if args.decompressor == "zlib" else shutil.which("pigz")
+    if _pigz is None and args.decompressor == "pigz":
+        raise FileNotFoundError("pigz is not installed or not on the PATH.")
+    logging.debug("Decompressing the reads with %s, %d MB ahead" % (_pigz or "zlib", args.read_ahead))
     os.makedirs(args.output, exist_ok=True)
     if not os.access(args.output, os.W_OK):
         raise PermissionError("Writing to the output directory %s is not permitted." % args.output)
     if len(os.listdir(args.output)) > 0:
         logging.warning("The output directory %s is not empty. Files may be overwritten if --overwrite is passed. "
                         "Otherwise, the program will fail without outputting results!" % args.output)
+    index_sample = None
+    if args.bgzf:
+        index_sample = args.sample or os.path.basename(os.path.normpath(args.output))
 
-    # Keep for database initialisation/updating.
-    logging.info("Loading ete3 NCBI Taxonomy database ...")
-    taxdb = NCBITaxa()
-    if args.update:
-        logging.info("Updating ete3 NCBI Taxonomy database ...")
-        taxdb.update_taxonomy_database()
+    checkpoints = None
+    state = None
+    if args.checkpoint:
+        for fname in args.checkpoint_files:
+            if not os.path.exists(fname):
+                raise FileNotFoundError("File %s (--checkpoint-files) does not exist." % fname)
+        inputs = [fname for fname in (args.input, args.input2, args.kaiju) if fname and not is_pipe(fname)]
+        inputs += args.checkpoint_files
+        # the files written besides the bins, a completed run is only skipped if they exist
+        outputs = [fname for fname in (args.kmer_hist, args.metrics, args.profile) if fname]
+        if args.bin_stats:
+            outputs.append(os.path.join(args.output, bin_stats.STATS_FILE))
+        options = {"taxranks": taxranks, "prefix": args.prefix, "split_mates": args.split_mates,
+                   "index_sample": index_sample, "taxonomy_index": args.taxonomy_index,
+                   "checkpoint_key": args.checkpoint_key, "output": os.path.realpath(args.output),
+                   "outputs": [os.path.realpath(fname) for fname in outputs],
+                   "kmer_hist": [args.kmer_size, args.kmer_memory] if args.kmer_hist else None}
+        checkpoints = checkpoint.Checkpoint(args.checkpoint, checkpoint.fingerprint(inputs, options),
+                                            args.checkpoint_interval * 1024 * 1024)
+        state = None if args.restart else checkpoints.load()
+        if state is not None and state["complete"]:
+            missing = [fname for fname in outputs if not os.path.exists(fname)]
+            missing += changed_bin_files(state["bins"], args.bgzf, args.kmer_hist)
+            if is_pipe(args.kaiju):
+                # the piped Kaiju output is not in the fingerprint (and has to be read to the end), bin it again
+                logging.info("Ignoring completed checkpoint %s, the Kaiju output is read from a pipe" % args.checkpoint)
+                state = None
+            elif missing:
+                logging.info("Ignoring completed checkpoint %s, %s is missing or was changed"
+                             % (args.checkpoint, missing[0]))
+                state = None
+            else:
+                logging.info("The reads were already binned according to checkpoint %s, nothing to do."
+                             % args.checkpoint)
+                return
 
-    fqid2otu, binnames = get_fqid_taxid(args.taxon_rank, args.kaiju, args.threads)
-    binfiles = get_bin_output_files(binnames, args.output, args.prefix, args.overwrite)
+    counter = None
+    if args.kmer_hist:
+        logging.debug("Counting %d-mers in a sketch of %d MB" % (args.kmer_size, args.kmer_memory))
+        counter = kmer_hist.KmerCounter(args.kmer_size, args.kmer_memory * 1024 * 1024)
+    binstats = bin_stats.BinStats() if args.bin_stats else None
+
+    with metrics.stage("taxonomy_loading"):
+        if args.taxonomy_index:
+            logging.info("Loading compiled taxonomy index %s ..." % args.taxonomy_index)
+            lineage_lookup.load_taxonomy_index(args.taxonomy_index)
+        else:
+            # Keep for database initialisation/updating.
+            logging.info("Loading ete3 NCBI Taxonomy database ...")
+            taxdb = lineage_lookup.get_taxdb()
+            if args.update:
+                logging.info("Updating ete3 NCBI Taxonomy database ...")
+                taxdb.update_taxonomy_database()
 
-    fhandles = {}
+    compress_threads = args.compress_threads or args.threads
+    logging.debug("Compressing output with %d threads at level %d" % (compress_threads, args.compress_level))
+    if index_sample is not None:
+        logging.debug("Writing BGZF bins with an index for sample %s" % index_sample)
+    writers = bin_writer.BinWriterPool(compress_threads, args.compress_level, max_open=args.max_open_files,
+                                       max_memory=args.buffer_memory * 1024 * 1024, index_sample=index_sample)
+    if checkpoints is not None:
+        checkpoints.writers = writers
+        if state is not None:
+            checkpoints.resume(state)
+    # a single rank is binned directly in the output directory, multiple ranks in a subdirectory per rank
+    outdirs = [args.output] if len(taxranks) == 1 else [os.path.join(args.output, rank) for rank in taxranks]
+    profiler = cProfile.Profile() if args.profile else None
     try:
-        logging.info("Opening file handles for %d bins ..." % len(binfiles))
-        fhandles = {binname: gzip.open(filename, "wt", compresslevel=4) for binname, filename in binfiles.items()}
-        bin_reads(fqid2otu, args.input, fhandles)
+        suffixes = ["_R1.fq.gz", "_R2.fq.gz"] if args.split_mates else [".fq.gz"]
+        matefiles = []
+        for suffix in suffixes:
+            rankfiles = []
+            for outdir in outdirs:
+                os.makedirs(outdir, exist_ok=True)
+                # the bins of a resumed run are continued
+                rankfiles.append(BinFiles(outdir, args.prefix, args.overwrite or state is not None, writers, suffix))
+            matefiles.append(rankfiles)
+        fhandles = MateFiles(*matefiles) if args.split_mates else RankFiles(matefiles[0])
+        observers = [observer for observer in (counter, binstats) if observer is not None]
+        if observers:
+            fhandles = ObservedFiles(fhandles, observers)
+        if args.stream:
+            # the Kaiju output is parsed and resolved while binning, so its stages are part of the binning stage
+            with metrics.stage("binning"), profiling(profiler):
+                bin_reads_stream(stream_fqid_bins(taxranks, args.kaiju), args.input, fhandles, args.input2,
+                                 checkpoints)
+        else:
+            fqid2otu, binnames = get_fqid_taxid(taxranks, args.kaiju, args.threads)
+            logging.info("Creating output files for %d bins ..." % sum(len(names) for names in binnames))
+            for rankfiles in matefiles:
+                for files, names in zip(rankfiles, binnames):
+                    for binname in names:
+                        files[binname]  # creates the (empty) output file
+            with metrics.stage("binning"), profiling(profiler):
+                if args.shards > 1:
+                    bin_reads_sharded(fqid2otu, args.input, fhandles, writers, args.shards,
+                                      args.shard_size * 1024 * 1024, checkpoints)
+                else:
+                    bin_reads(fqid2otu, args.input, fhandles, args.input2, checkpoints)
+        if isinstance(fhandles, ObservedFiles):
+            fhandles.flush()
     except:
         raise
     finally:
-        logging.info("Closing file handles ...")
-        for fhandle in fhandles.values():
-            fhandle.close()
+        logging.info("Flushing and closing output files ...")
+        with metrics.stage("flushing"):
+            writers.close()
+    if counter is not None:
+        write_kmer_hists(counter, args.kmer_hist, outdirs, args.prefix)
+    if binstats is not None:
+        write_bin_stats(binstats, args.output, outdirs, args.prefix)
+    if checkpoints is not None:
+        checkpoints.save(complete=True)
+    if profiler is not None:
+        write_profile(profiler, args.profile)
+    if args.metrics:
+        logging.info("Writing metrics to %s ..." % args.metrics)
+        bins = writers.stats()
+        metrics.count("output_bytes", sum(stats["bytes"] for stats in bins.values()))
+        metrics.count("compressed_output_bytes", sum(stats["compressed_bytes"] for stats in bins.values()))
+        metrics.write(args.metrics, OrderedDict((os.path.relpath(filename, args.output), stats)
+                                                for filename, stats in bins.items()))
+
+
+class profiling(object):
+    """ Context manager enabling the given profiler (if any) in the enclosed block """
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+
+
+def write_profile(profiler, filename):
+    """
+    Dumps the profile of the binning loop for pstats/snakeviz and writes the most expensive calls next to it as text.
+    """
+    logging.info("Writing profile of the binning loop to %s ..." % filename)
+    profiler.dump_stats(filename)
+    with open(filename + ".txt", "w") as fout:
+        pstats.Stats(profiler, stream=fout).sort_stats("cumulative").print_stats(40)
+
+
+class BinFiles(dict):
+    """ Writers of the bins, created when a bin is written to for the first time """
+    def __init__(self, outdir, prefix, overwrite, writers, suffix=".fq.gz"):
+        dict.__init__(self)
+        self.outdir = outdir
+        self.prefix = prefix
+        self.overwrite = overwrite
+        self.writers = writers
+        self.suffix = suffix
+
+    def __missing__(self, binname):
+        filename = get_bin_output_files([binname], self.outdir, self.prefix, self.overwrite, self.suffix)[binname]
+        logging.debug("Creating output file for bin %s ..." % binname)
+        fhandle = self[binname] = self.writers.open(filename)
+        return fhandle
+
+
+class RankFiles(dict):
+    """ Writers of the bins of a read at every rank, keyed by the tuple of bin names (one for each rank) """
+    def __init__(self, rankfiles):
+        dict.__init__(self)
+        self.rankfiles = rankfiles
+        self.root = ("root",) * len(rankfiles)
+
+    def __missing__(self, otu):
+        fhandle = self[otu] = RankWriter([files[binname] for files, binname in zip(self.rankfiles, otu)])
+        return fhandle
+
+
+class RankWriter(object):
+    """ Writes the same records to the bins of multiple ranks """
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write(self, data):
+        for writer in self.writers:
+            writer.write(data)
+
+
+class MateFiles(RankFiles):
+    """
+    Like RankFiles, but writes the first and second mate of every pair to the R1 and R2 bins respectively. Requires
+    the mates of a pair to be written directly after each other.
+    """
+    def __init__(self, rankfiles, rankfiles2):
+        RankFiles.__init__(self, rankfiles)
+        self.rankfiles2 = rankfiles2
+
+    def __missing__(self, otu):
+        fhandle = self[otu] = MateWriter(RankFiles.__missing__(self, otu),
+                                         RankWriter([files[binname] for files, binname in zip(self.rankfiles2, otu)]))
+        return fhandle
+
+
+class MateWriter(object):
+    """ Writes records alternately to the writer of the first and the second mate """
+    def __init__(self, writer, writer2):
+        self.writers = (writer, writer2)
+        self.mate = 0
+
+    def write(self, data):
+        self.writers[self.mate].write(data)
+        self.mate ^= 1
+
+
+class ObservedFiles(dict):
+    """
+    Wraps RankFiles or MateFiles, passing the OTU and record of everything written to the observers as well. The
+    observers get the records in batches (observer.add(otus, records)), the last batch on flush().
+    """
+    def __init__(self, filehandles, observers):
+        dict.__init__(self)
+        self.filehandles = filehandles
+        self.observers = observers
+        self.root = filehandles.root
+        self.rankfiles = filehandles.rankfiles
+        self.otus = []
+        self.records = []
+
+    def __missing__(self, otu):
+        fhandle = self[otu] = ObservedWriter(self, otu, self.filehandles[otu])
+        return fhandle
+
+    def observe(self, otu, record):
+        """ Passes a record to the observers without writing it """
+        self.otus.append(otu)
+        self.records.append(record)
+        if len(self.records) >= LOOKUP_BATCH:
+            self.flush()
 
+    def observe_records(self, fqid2bin, records):
+        """ Passes (read ID, record) pairs to the observers with the OTUs linked to the read IDs """
+        self.flush()
+        while True:
+            batch = list(islice(records, LOOKUP_BATCH))
+            if not batch:
+                break
+            otus = [fqid2bin.binnames[binidx] for binidx in fqid2bin.lookup([fqid for fqid, record in batch]).tolist()]
+            for observer in self.observers:
+                observer.add(otus, [record for fqid, record in batch])
 
-def get_bin_output_files(binnames, outdir, prefix, overwrite):
+    def flush(self):
+        if self.records:
+            for observer in self.observers:
+                observer.add(self.otus, self.records)
+        self.otus = []
+        self.records = []
+
+
+class ObservedWriter(object):
+    """ Writes records to the writer of an OTU and passes them to the observers """
+    def __init__(self, files, otu, writer):
+        self.files = files
+        self.otu = otu
+        self.writer = writer
+
+    def write(self, data):
+        self.files.observe(self.otu, data)
+        self.writer.write(data)
+
+
+def write_kmer_hists(counter, histfile, outdirs, prefix):
+    """
+    Writes the k-mer depth histogram of the sample to the given file and the histogram of every bin next to the bin.
+    """
+    logging.info("Writing k-mer histograms ...")
+    sample, bins = counter.histograms()
+    kmer_hist.write_hist(histfile, sample)
+    for (rank, binname), histogram in bins.items():
+        kmer_hist.write_hist(get_bin_output_files([binname], outdirs[rank], prefix, True, ".hist")[binname], histogram)
+
+
+def write_bin_stats(binstats, outdir, outdirs, prefix):
+    """
+    Writes the read statistics of the bins to the statistics file in the output directory, naming each bin by its
+    path relative to the output directory (without extension).
+    """
+    logging.info("Writing bin statistics ...")
+    bins = OrderedDict()
+    for (rank, binname), stats in binstats.bins.items():
+        binfile = get_bin_output_files([binname], outdirs[rank], prefix, True, "")[binname]
+        bins[os.path.relpath(binfile, outdir)] = stats
+    bin_stats.write_stats(os.path.join(outdir, bin_stats.STATS_FILE), bins)
+
+
+def changed_bin_files(bins, index, hists):
+    """
+    Returns the bins of a completed checkpoint that are missing or of another size than recorded, along with the
+    missing index (with --bgzf) and k-mer histogram (with --kmer-hist) files next to them.
+    """
+    changed = []
+    for state in bins:
+        fname = state["filename"]
+        if not os.path.exists(fname) or os.path.getsize(fname) != state["compressed"]:
+            changed.append(fname)
+        if index and not os.path.exists(fname + bin_index.INDEX_SUFFIX):
+            changed.append(fname + bin_index.INDEX_SUFFIX)
+        # the histogram of a bin is shared by its mates and only written if the bin has reads
+        histfile = re.sub(r"(_R[12])?\.fq\.gz$", ".hist", fname)
+        if hists and state["records"] > 0 and not os.path.exists(histfile):
+            changed.append(histfile)
+    return changed
+
+
+def is_pipe(kaijufile):
+    """ Returns whether the Kaiju output is read from standard input ("-") or a named pipe """
+    return kaijufile == "-" or stat.S_ISFIFO(os.stat(kaijufile).st_mode)
+
+
+def open_kaiju(kaijufile):
+    """
+    Opens the Kaiju output for reading in binary mode, "-" being standard input.
+    """
+    if kaijufile == "-":
+        return open(sys.stdin.fileno(), "rb", closefd=False)
+    return open(kaijufile, "rb")
+
+
+def get_taxon_ranks(taxon_ranks):
+    """
+    Returns the requested ranks (given as separate arguments or comma-separated) in the order of the taxonomy.
+    """
+    taxranks = set(rank for ranks in taxon_ranks for rank in ranks.split(",") if rank)
+    for rank in taxranks:
+        if rank not in lineage_lookup.tax_ranks:
+            raise ValueError("The given rank '%s' is not supported." % rank)
+    if not taxranks:
+        raise ValueError("No taxonomic rank given.")
+    return tuple(rank for rank in lineage_lookup.tax_ranks if rank in taxranks)
+
+
+def get_bin_output_files(binnames, outdir, prefix, overwrite, suffix=".fq.gz"):
     """
     Assigns an output file to each bin.
 
@@ -80,7 +465,7 @@ def get_bin_output_files(binnames, outdir, prefix, overwrite):
     namepattern = re.compile("[\W]+")
     for names in binnames:
         fname = namepattern.sub("", names.lower())
-        fname = prefix + fname + ".fq.gz"
+        fname = prefix + fname + suffix
         flocation = os.path.join(outdir, fname)
         binfiles[names] = flocation
     for path in binfiles.values():
@@ -93,77 +478,572 @@ def get_bin_output_files(binnames, outdir, prefix, overwrite):
     return binfiles
 
 
-def bin_reads(fqid2bin, fqfile, filehandles):
+class InflateReader(io.RawIOBase):
+    """
+    Raw reader of a (multi-member) gzip file, recording the time spent decompressing and the amount of data read.
+    Wrap it in a BufferedReader to read lines.
+    """
+    def __init__(self, fileobj, chunksize=READ_BUFFER):
+        self.fileobj = fileobj
+        self.chunksize = chunksize
+        self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.in_member = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            if self.inflater.eof:  # the next gzip member starts in the unused data
+                data = self.inflater.unused_data
+                self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.in_member = False
+            else:
+                data = self.inflater.unconsumed_tail
+            if not data:
+                data = self.fileobj.read(self.chunksize)
+                if not data:
+                    if self.in_member:
+                        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                    return 0
+                metrics.count("input_bytes", len(data))
+            self.in_member = True
+            with metrics.thread_stage("decompression"):
+                out = self.inflater.decompress(data, len(buf))
+            if out:
+                buf[:len(out)] = out
+                metrics.count("uncompressed_input_bytes", len(out))
+                return len(out)
+
+    def close(self):
+        if not self.closed:
+            self.fileobj.close()
+        io.RawIOBase.close(self)
+
+
+class PigzReader(io.RawIOBase):
     """
-    Bins the reads in separate files based on the OTU linked to the read ID.
+    Raw reader of a gzip file decompressed by a pigz process, which decompresses while the records are parsed.
+    """
+    def __init__(self, fqfile, pigz="pigz"):
+        self.fqfile = fqfile
+        self.process = subprocess.Popen([pigz, "-dc", fqfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        metrics.count("input_bytes", os.path.getsize(fqfile))
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        nbytes = self.process.stdout.readinto(buf)
+        if nbytes:
+            metrics.count("uncompressed_input_bytes", nbytes)
+            return nbytes
+        if self.process.wait() != 0:
+            raise EOFError("pigz could not decompress %s: %s"
+                           % (self.fqfile, self.process.stderr.read().decode(errors="replace").strip()))
+        return 0
+
+    def close(self):
+        if not self.closed:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process.stderr.close()
+        io.RawIOBase.close(self)
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Reads blocks from a raw reader in a separate thread, at most the given amount of blocks ahead of the consumer.
+    zlib and pipe reads release the GIL, so the decompression overlaps with the parsing of the records. Errors of
+    the raw reader are raised in the consumer.
+    """
+    def __init__(self, raw, blocks, blocksize=READ_BUFFER):
+        self.raw = raw
+        self.blocksize = blocksize
+        self.blocks = queue.Queue(blocks)
+        self.block = memoryview(b"")
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.read_ahead, name="read-ahead", daemon=True)
+        self.thread.start()
+
+    def read_ahead(self):
+        try:
+            while not self.stopped.is_set():
+                data = self.raw.read(self.blocksize)
+                self.blocks.put(data)
+                if not data:
+                    break
+        except Exception as ex:
+            self.blocks.put(ex)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self.block:
+            data = self.blocks.get()
+            if isinstance(data, Exception) or not data:
+                self.blocks.put(data)  # the end of the file (or the error) stays
+                if data:
+                    raise data
+                return 0
+            self.block = memoryview(data)
+        nbytes = min(len(buf), len(self.block))
+        buf[:nbytes] = self.block[:nbytes]
+        self.block = self.block[nbytes:]
+        return nbytes
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            while self.thread.is_alive():  # unblock the reader thread
+                try:
+                    self.blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.raw.close()
+        io.RawIOBase.close(self)
+
+
+def open_fastq(fqfile):
+    """
+    Opens a gzipped FASTQ file for reading in binary mode. The file is decompressed by pigz (if set) or zlib, ahead
+    of the reader in a separate thread if read-ahead is enabled.
+    """
+    if _pigz is not None:
+        raw = PigzReader(fqfile, _pigz)
+    else:
+        raw = InflateReader(open(fqfile, "rb"))
+    if _read_ahead > 0:
+        raw = ReadAheadReader(raw, _read_ahead)
+    return io.BufferedReader(raw, READ_BUFFER)
+
+
+def read_fastq(fin):
+    """
+    Yields the ID and the unmodified bytes of every record in a FASTQ file opened in binary mode.
+    """
+    readline = fin.readline
+    while True:
+        header = readline()
+        if not header:
+            return
+        record = header + readline() + readline()
+        qual = readline()
+        if not qual or header[0] != 64:  # b"@"
+            raise ValueError("Malformed or truncated FASTQ record %s" % header.rstrip().decode(errors="replace"))
+        if qual[-1] != 10:  # no b"\n" at the end of the file
+            qual += b"\n"
+        yield header[1:].split(None, 1)[0], record + qual
+
+
+@contextmanager
+def open_reads(fqfile, fqfile2=None):
+    """
+    Yields an iterator over the (read ID, record) pairs of a FASTQ file. Given a second file with the second mates,
+    both files are read in lockstep and the mates are interleaved.
+    """
+    with open_fastq(fqfile) as fin:
+        if fqfile2 is None:
+            yield read_fastq(fin)
+        else:
+            with open_fastq(fqfile2) as fin2:
+                yield interleave_mates(read_fastq(fin), read_fastq(fin2))
+
+
+def interleave_mates(records, records2):
+    """
+    Yields the records of the first and second mates after each other, both with the read ID of the first mate.
+    """
+    for mate, mate2 in zip_longest(records, records2):
+        if mate is None or mate2 is None:
+            raise ValueError("The FASTQ files do not contain the same amount of reads (read %s has no mate)."
+                             % (mate or mate2)[0].decode())
+        fqid, fqid2 = mate[0], mate2[0]
+        # old style read names end in /1 and /2
+        if fqid != fqid2 and not (fqid[:-1] == fqid2[:-1] and fqid.endswith(b"/1") and fqid2.endswith(b"/2")):
+            raise ValueError("The FASTQ files are out of sync (first mate %s, second mate %s)."
+                             % (fqid.decode(), fqid2.decode()))
+        yield mate
+        yield fqid, mate2[1]
+
+
+def bin_reads(fqid2bin, fqfile, filehandles, fqfile2=None, checkpoints=None):
+    """
+    Bins the reads in separate files based on the OTU linked to the read ID. The reads binned before the checkpoint
+    (if any) are skipped.
     """
     logging.info("Binning reads ...")
-    with gzip.open(fqfile, "rt") as fin:
-        previd = ""
-        prevotu = "root"
-        for record in SeqIO.parse(fin, "fastq"):
-            otu = ""
-            if record.id == previd:  # Bins PE reads together
-                otu = prevotu
+    with open_reads(fqfile, fqfile2) as records:
+        if checkpoints is not None and checkpoints.records > 0:
+            logging.info("Skipping %d records binned before the checkpoint ..." % checkpoints.records)
+            if isinstance(filehandles, ObservedFiles):
+                filehandles.observe_records(fqid2bin, islice(records, checkpoints.records))
             else:
-                otu = fqid2bin.get(record.id, "root")
-                previd = record.id
-                prevotu = otu
-            SeqIO.write(record, filehandles[otu], "fastq")
-#            logging.debug("Writing record %s to %s" % (record.id, otu))
+                deque(islice(records, checkpoints.records), maxlen=0)
+        bin_records(fqid2bin, records, filehandles, checkpoints)
 
 
-def get_fqid_taxid(taxrank, kaijufile, workerthreads):
+def bin_records(fqid2bin, records, filehandles, checkpoints=None):
+    """
+    Writes the (read ID, record) pairs to the file handle of the OTU linked to the read ID. The read IDs are looked up
+    in batches, after every batch the checkpoint (if any) is advanced.
     """
-    Maps the IDs of the reads to an OTU in a dict. Also returns all the names
-    of the bins in a list.
+    binhandles = [None] * len(fqid2bin.binnames)
+    while True:
+        batch = list(islice(records, LOOKUP_BATCH))
+        if not batch:
+            break
+        metrics.count("reads", len(batch))
+        binindices = fqid2bin.lookup([fqid for fqid, record in batch]).tolist()
+        for (fqid, record), binidx in zip(batch, binindices):  # PE reads share their ID, so are binned together
+            fhandle = binhandles[binidx]
+            if fhandle is None:
+                fhandle = binhandles[binidx] = filehandles[fqid2bin.binnames[binidx]]
+            fhandle.write(record)
+#            logging.debug("Writing record %s to %s" % (fqid, fqid2bin.binnames[binidx]))
+        if checkpoints is not None:
+            checkpoints.advance(len(batch), sum(len(record) for fqid, record in batch))
+
+
+def read_shards(fin, shardsize):
+    """
+    Yields chunks of about the given size from a FASTQ file opened in binary mode, split at record boundaries.
+    """
+    remainder = b""
+    while True:
+        block = fin.read(shardsize)
+        if not block:
+            break
+        data = remainder + block
+        # cut after the last line that completes a record (4 lines per record)
+        lines = data.count(b"\n")
+        if lines < 4:
+            remainder = data
+            continue
+        cut = len(data)
+        for _ in range(lines % 4 + 1):
+            cut = data.rfind(b"\n", 0, cut)
+        yield data[:cut + 1]
+        remainder = data[cut + 1:]
+    if remainder:
+        yield remainder
+
+
+# set before the shard workers are forked, so every worker shares the same read ID mapping
+_shard_fqid2bin = None
+_shard_ranks = 1
+_shard_compresslevel = 4
+_shard_bgzf = False
+
+
+def bin_shard(shard):
+    """
+    Bins the records of a single shard. Returns the compressed records of every bin as a single gzip member (or as
+    BGZF blocks with their index), along with the amount of records and the wall and CPU time spent compressing.
+
+    ({(rank index, binname): (member, records, uncompressed size, index)}, records, (wall seconds, CPU seconds))
+    """
+    binned = [defaultdict(ShardBin) for _ in range(_shard_ranks)]
+    bin_records(_shard_fqid2bin, read_fastq(io.BytesIO(shard)), RankFiles(binned))
+    nrecords = sum(len(data.records) for data in binned[0].values())  # every record is in a bin of the first rank
+    start = time.perf_counter()
+    cpu = time.thread_time()
+    members = {}
+    for idx, files in enumerate(binned):
+        for binname, data in files.items():
+            if not data.records:
+                continue
+            member, index = bin_writer.compress_records(data.records, _shard_compresslevel, _shard_bgzf)
+            members[(idx, binname)] = (member, len(data.records), data.size, index)
+    return members, nrecords, (time.perf_counter() - start, time.thread_time() - cpu)
+
+
+class ShardBin(object):
+    """ Records of a bin within a single shard """
+    def __init__(self):
+        self.records = []
+        self.size = 0
+
+    def write(self, data):
+        self.records.append(data)
+        self.size += len(data)
+
+
+def bin_reads_sharded(fqid2bin, fqfile, filehandles, writers, shards, shardsize, checkpoints=None):
+    """
+    Bins the reads in record-aligned shards, each shard in a separate process. The results of the shards are
+    appended to the bins as gzip members in the order of the shards, which keeps the order of the reads. The input
+    binned before the checkpoint (if any) is skipped.
+    """
+    global _shard_fqid2bin, _shard_ranks, _shard_compresslevel, _shard_bgzf
+    logging.info("Binning reads in shards of %d MB using %d processes ..." % (shardsize // (1024 * 1024), shards))
+    _shard_fqid2bin = fqid2bin
+    _shard_ranks = len(filehandles.rankfiles)
+    _shard_compresslevel = writers.compresslevel
+    _shard_bgzf = writers.index_sample is not None
+    pool = multiprocessing.get_context("fork").Pool(shards)
+    pending = deque()
+    nshards = 0
+
+    def write_shard(result, shard):
+        members, nrecords, times = result.get()
+        metrics.count("reads", nrecords)
+        metrics.add_time("compression", *times)
+        for (idx, binname), (member, records, size, index) in members.items():
+            writers.write_member(filehandles.rankfiles[idx][binname], member, records, size, index)
+        if isinstance(filehandles, ObservedFiles):
+            filehandles.observe_records(fqid2bin, read_fastq(io.BytesIO(shard)))
+        if checkpoints is not None:
+            checkpoints.advance(nrecords, len(shard))
+
+    def skip_records(records):
+        """ Yields the records of the input binned before the checkpoint """
+        skipped = 0
+        for fqid, record in records:
+            yield fqid, record
+            skipped += len(record)
+            if skipped >= checkpoints.input_bytes:
+                return
+        raise ValueError("%s is shorter than the input binned before the checkpoint." % fqfile)
+
+    try:
+        with open_fastq(fqfile) as fin:
+            if checkpoints is not None and checkpoints.input_bytes > 0:
+                logging.info("Skipping %d bytes binned before the checkpoint ..." % checkpoints.input_bytes)
+                if isinstance(filehandles, ObservedFiles):
+                    # the skipped input ends at a record boundary, as the shards did
+                    filehandles.observe_records(fqid2bin, skip_records(read_fastq(fin)))
+                else:
+                    skipped = 0
+                    while skipped < checkpoints.input_bytes:
+                        data = fin.read(min(checkpoints.input_bytes - skipped, shardsize))
+                        if not data:
+                            raise ValueError("%s is shorter than the input binned before the checkpoint." % fqfile)
+                        skipped += len(data)
+            for shard in read_shards(fin, shardsize):
+                pending.append((pool.apply_async(bin_shard, (shard,)), shard))
+                nshards += 1
+                # keep the shard order, blocking when too many shards are in flight
+                while pending and (pending[0][0].ready() or len(pending) > 2 * shards):
+                    write_shard(*pending.popleft())
+        while pending:
+            write_shard(*pending.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    logging.debug("Binned %d shards" % nshards)
+
+
+def get_fqid_taxid(taxranks, kaijufile, workerthreads):
+    """
+    Maps the IDs of the reads to an OTU (the tuple of its bins at the given
+    ranks) in a ReadTaxidStore. Also returns the names of the bins of every
+    rank.
     """
     logging.info("Assigning reads to OTUs ...")
-    fqids = {}
 
     logging.info("Loading %s into memory ..." % kaijufile)
-    with open(kaijufile, "r") as fin:
-        for line in fin:
-            if line[0] != 'C':
-                continue
-            line = line.split()
-            taxid = line[2].strip()
-            fqid = line[1].strip()
-            fqids[fqid] = taxid
+    with metrics.stage("kaiju_parsing"):
+        fqids = read_store.ReadTaxidStore.from_kaiju(kaijufile, root=("root",) * len(taxranks))
 
-    # multithreaded taxonomy lookups
+    # multithreaded taxonomy lookups, once for every distinct taxon
     logging.info("Resolving lineages of taxa (slow) ...")
     logging.debug("Amount of worker threads set to %d" % workerthreads)
-    lineage_pool = lineage_lookup.ThreadPool(workerthreads)
-    for fqid in fqids:
-        lineage_pool.add_task(lineage_lookup.get_bin, taxrank, fqid, fqids)
-    logging.debug("Waiting for workers to finish ...")
-    lineage_pool.wait_completion()
+    with metrics.stage("lineage_resolution"):
+        taxid2bin = lineage_lookup.resolve_taxids(taxranks, fqids.unique_taxids().tolist(), workerthreads)
+        fqids.assign_bins(taxid2bin)
+    logging.debug("Resolved %d distinct taxa for %d reads" % (len(taxid2bin), len(fqids)))
+    # every classified read beyond the first of its taxon is served from the resolved taxa
+    metrics.count("classified_reads", len(fqids))
+    metrics.count("lineage_lookups", len(taxid2bin))
+    metrics.count("lineage_cache_hits", len(fqids) - len(taxid2bin))
 
     logging.info("Parsing indentified bins ...")
-    binnames = set(x for x in fqids.values())
+    binnames = [set(otu[idx] for otu in fqids.binnames) for idx in range(len(taxranks))]
 
     return fqids, binnames
 
 
+def bin_reads_stream(fqid_bins, fqfile, filehandles, fqfile2=None, checkpoints=None):
+    """
+    Bins the reads by walking the FASTQ file and the (read ID, OTU) pairs of the Kaiju output in lockstep. Kaiju
+    writes its results in the same order as the input reads, so only the current read has to be kept in memory.
+    The reads binned before the checkpoint (if any) are walked, but not written.
+    """
+    logging.info("Binning reads (streaming) ...")
+    nrecords = 0
+    skip = 0 if checkpoints is None else checkpoints.records
+    if skip > 0:
+        logging.info("Skipping %d records binned before the checkpoint ..." % skip)
+    unsaved = 0
+    observed = isinstance(filehandles, ObservedFiles)
+    with open_reads(fqfile, fqfile2) as records:
+        previd = b""
+        prevotu = filehandles.root
+        for fqid, record in records:
+            nrecords += 1
+            if fqid != previd:  # PE reads share a single Kaiju result
+                try:
+                    kaijuid, prevotu = next(fqid_bins)
+                except StopIteration:
+                    raise ValueError("The Kaiju output ended before read %s in %s." % (fqid.decode(), fqfile))
+                if kaijuid != fqid:
+                    raise ValueError("The Kaiju output and %s are out of sync (Kaiju read %s, FASTQ read %s)."
+                                     % (fqfile, kaijuid.decode(), fqid.decode()))
+                previd = fqid
+            if nrecords <= skip:
+                if observed:
+                    filehandles.observe(prevotu, record)
+                continue
+            filehandles[prevotu].write(record)
+            if checkpoints is not None:
+                unsaved += len(record)
+                if nrecords % LOOKUP_BATCH == 0:
+                    checkpoints.advance(nrecords - checkpoints.records, unsaved)
+                    unsaved = 0
+    if checkpoints is not None and nrecords > checkpoints.records:
+        checkpoints.advance(nrecords - checkpoints.records, unsaved)
+    metrics.count("reads", nrecords)
+    leftover = next(fqid_bins, None)
+    if leftover is not None:
+        raise ValueError("The Kaiju output contains reads not in %s (starting at read %s)."
+                         % (fqfile, leftover[0].decode()))
+
+
+def stream_fqid_bins(taxranks, kaijufile):
+    """
+    Yields the read ID and OTU of every read in the Kaiju output, in file order. Each distinct TaxID is resolved
+    only once. The lines are parsed in batches, so the parsing and the lineage resolution are timed as stages of
+    their own (within the binning stage).
+    """
+    root = ("root",) * len(taxranks)
+    taxid2bin = {}
+    classified = 0
+    with open_kaiju(kaijufile) as fin:
+        while True:
+            with metrics.thread_stage("kaiju_parsing"):
+                lines = [line.split() for line in islice(fin, LOOKUP_BATCH)]
+            if not lines:
+                break
+            for line in lines:
+                if line[0] != b"C":
+                    yield line[1], root
+                    continue
+                classified += 1
+                taxid = line[2]
+                if taxid not in taxid2bin:
+                    with metrics.thread_stage("lineage_resolution"):
+                        taxid2bin[taxid] = lineage_lookup.get_bins(taxranks, int(taxid))
+                yield line[1], taxid2bin[taxid]
+    logging.debug("Resolved %d distinct taxa" % len(taxid2bin))
+    metrics.count("classified_reads", classified)
+    metrics.count("lineage_lookups", len(taxid2bin))
+    metrics.count("lineage_cache_hits", classified - len(taxid2bin))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog=sys.argv[0], description="Generates OTUs from Kaiju output.", epilog=_epilog)
     optional = parser._action_groups.pop()
     required = parser.add_argument_group("required arguments")
     # Required arguments
     required.add_argument("-t", "--taxon-rank",
-                          help="The taxonomic rank used for separation (any of %s)" % ", ".join(lineage_lookup.tax_ranks),
+                          help="The taxonomic rank(s) used for separation (any of %s). Multiple ranks are binned in a "
+                               "single pass, in a subdirectory per rank" % ", ".join(lineage_lookup.tax_ranks),
+                          action="store", type=str, nargs="+", required=True)
+    required.add_argument("-k", "--kaiju",
+                          help="The Kaiju result file, a named pipe or - to read it from standard input (implies "
+                               "--stream)",
+                          action="store", type=str, required=True)
+    required.add_argument("-i", "--input",
+                          help="The gzipped FASTQ file used for the Kaiju analysis (the first mates with --input2)",
                           action="store", type=str, required=True)
-    required.add_argument("-k", "--kaiju", help="The Kaiju result file", action="store", type=str, required=True)
-    required.add_argument("-i", "--input", help="The gzipped FASTQ file used for the Kaiju analysis", action="store",
-                          type=str, required=True)
     required.add_argument("-o", "--output", help="Output location for the OTUs (gzipped FASTQ files)", action="store",
                           type=str, required=True)
     # Optional arguments
+    optional.add_argument("-j", "--input2",
+                          help="The gzipped FASTQ file with the second mates, read in lockstep with --input",
+                          action="store", type=str)
+    optional.add_argument("--split-mates",
+                          help="Write the mates to separate _R1 and _R2 files per bin instead of interleaving them "
+                               "(requires --input2)",
+                          action="store_true")
     optional.add_argument("-p", "--prefix", help="File prefix to use when creating output files", type=str, default="")
     optional.add_argument("-f", "--overwrite", help="Overwrite existing files", action="store_true")
     optional.add_argument("-u", "--update", help="Checks the NCBI Taxonomy database for updates", action="store_true")
+    optional.add_argument("-x", "--taxonomy-index",
+                          help="Use the taxonomy index compiled by taxonomy_index.py instead of the ete3 database",
+                          type=str, action="store")
+    optional.add_argument("-s", "--stream",
+                          help="Walk the Kaiju output and the FASTQ file in lockstep instead of loading the Kaiju "
+                               "output into memory (requires both to be in the same read order)",
+                          action="store_true")
     optional.add_argument("--threads", help="Specify the number of threads to use", type=int, action="store", default=1)
+    optional.add_argument("--shards",
+                          help="Number of processes binning record-aligned shards of the FASTQ file in parallel "
+                               "(can not be combined with --stream)",
+                          type=int, action="store", default=1)
+    optional.add_argument("--shard-size", help="Uncompressed size of a shard in MB", type=int, action="store",
+                          default=16)
+    optional.add_argument("--compress-threads",
+                          help="Number of threads compressing the output (default: the value of --threads)",
+                          type=int, action="store")
+    optional.add_argument("--compress-level", help="gzip compression level of the output (1-9)", type=int,
+                          action="store", default=4, choices=range(1, 10), metavar="{1-9}")
+    optional.add_argument("--read-ahead",
+                          help="Amount of decompressed input in MB read ahead of the parsing, in a separate thread (0 "
+                               "to decompress in the parsing thread)",
+                          type=int, action="store", default=READ_AHEAD)
+    optional.add_argument("--decompressor",
+                          help="Decompress the FASTQ files with pigz or zlib (auto: pigz if it is installed)",
+                          choices=["auto", "pigz", "zlib"], action="store", default="auto")
+    optional.add_argument("--max-open-files", help="Maximum number of bin files that are open at the same time",
+                          type=int, action="store", default=bin_writer.MAX_OPEN)
+    optional.add_argument("--buffer-memory", help="Maximum amount of buffered (uncompressed) output in MB",
+                          type=int, action="store", default=bin_writer.MAX_MEMORY // (1024 * 1024))
+    optional.add_argument("-b", "--bgzf",
+                          help="Write the bins as BGZF blocks with an index of the records (BIN.fq.gz.idx), so reads "
+                               "can be extracted with bin_index.py without decompressing the whole bin",
+                          action="store_true")
+    optional.add_argument("--sample", help="Name of the sample in the index of --bgzf (default: the name of the output "
+                                           "directory)",
+                          type=str, action="store")
+    optional.add_argument("-c", "--checkpoint",
+                          help="Save the progress to this file every --checkpoint-interval MB of input; a rerun with "
+                               "the same input and options resumes from it (or does nothing if the run completed)",
+                          type=str, action="store")
+    optional.add_argument("--checkpoint-interval", help="Uncompressed input in MB between checkpoints", type=int,
+                          action="store", default=1024)
+    optional.add_argument("--checkpoint-key",
+                          help="Text identifying input that is not read from a file, added to the fingerprint of the "
+                               "checkpoint (e.g. the options and database of a Kaiju that pipes its output)",
+                          type=str, action="store")
+    optional.add_argument("--checkpoint-files",
+                          help="Other files the bins depend on, added to the fingerprint of the checkpoint (e.g. the "
+                               "database of a Kaiju that pipes its output)",
+                          type=str, nargs="+", action="store", default=[])
+    optional.add_argument("--restart", help="Ignore the checkpoint and start from scratch", action="store_true")
+    optional.add_argument("--kmer-hist",
+                          help="Count the k-mers of the reads and write their depth histogram to this file (the "
+                               "histogram of every bin is written next to the bin)",
+                          type=str, action="store")
+    optional.add_argument("--kmer-size", help="Length of the counted k-mers (at most 32)", type=int, action="store",
+                          default=31)
+    optional.add_argument("--kmer-memory",
+                          help="Memory for the k-mer counts in MB (half for the sketch, half for the distinct k-mers)",
+                          type=int, action="store", default=1024)
+    optional.add_argument("--bin-stats",
+                          help="Write the amount of reads and bases, mean quality, GC fraction and length histogram of "
+                               "every bin to %s in the output directory" % bin_stats.STATS_FILE, action="store_true")
+    optional.add_argument("-m", "--metrics", help="Write the timings and counters of the run to this JSON file",
+                          type=str, action="store")
+    optional.add_argument("--profile",
+                          help="Profile the binning loop with cProfile and dump the statistics to this file (a text "
+                               "summary is written to FILE.txt; with --shards only the main process is profiled)",
+                          type=str, action="store", metavar="FILE")
     # Standard arguments
     optional.add_argument("-v", "--verbose", help="Increase verbosity level", action="count")
     optional.add_argument("-q", "--silent", help="Suppresses output messages, overriding the --verbose argument",
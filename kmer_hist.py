@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+import logging
+
+import numpy as np
+
+# local libraries
+import metrics
+
+"""
+MIT License
+"""
+
+
+# rows (independent hash functions) of the count-min sketch
+SKETCH_ROWS = 4
+# fraction of overestimated k-mer depths above which the sketch is reported to be too small
+MAX_OVERESTIMATED = 0.05
+# depths from this one up are added to the last line of a histogram
+HIST_DEPTH = 1000
+HIST_HEADER = "#Depth\tRaw_Count\tUnique_Kmers\n"
+# 2-bit codes of the nucleotides, 4 for anything else
+_CODES = np.full(256, 4, dtype=np.uint64)
+for _code, _bases in enumerate((b"Aa", b"Cc", b"Gg", b"Tt")):
+    _CODES[list(_bases)] = _code
+# splitmix64 finalizer constants
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+
+
+def mix(keys):
+    """ Scrambles 64-bit keys (splitmix64 finalizer), vectorized """
+    keys = (keys ^ (keys >> np.uint64(30))) * _MIX1
+    keys = (keys ^ (keys >> np.uint64(27))) * _MIX2
+    return keys ^ (keys >> np.uint64(31))
+
+
+def canonical_kmers(seqs, k):
+    """
+    Returns the canonical k-mers (the smaller of a k-mer and its reverse complement, 2 bits per base) of the given
+    sequences, along with the index of the sequence each k-mer belongs to. K-mers holding other bases than ACGT are
+    skipped.
+    """
+    lengths = np.array([len(seq) + 1 for seq in seqs], dtype=np.int64)
+    # separate the sequences with an invalid base, so no k-mer spans two sequences
+    codes = _CODES[np.frombuffer(b"\n".join(seqs) + b"\n", dtype=np.uint8)]
+    nkmers = len(codes) - k + 1
+    if nkmers <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = invalid[k:k + nkmers] == invalid[:nkmers]
+    codes &= np.uint64(3)
+    forward = np.zeros(nkmers, dtype=np.uint64)
+    reverse = np.zeros(nkmers, dtype=np.uint64)
+    for pos in range(k):
+        window = codes[pos:pos + nkmers]
+        forward = (forward << np.uint64(2)) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * pos)
+    owner = np.repeat(np.arange(len(seqs)), lengths)[:nkmers]
+    return np.minimum(forward, reverse)[valid], owner[valid]
+
+
+class KmerCounter(object):
+    """
+    Counts the k-mers of the binned reads for the whole sample and for every bin, in a count-min sketch (the bin is
+    hashed along with the k-mer, so all share the same sketch). Half of the memory goes to the sketch, the other
+    half to the distinct k-mers seen: a sorted array of their hashes, holding all of them or, once it is full, only
+    those of which the hash starts with `level` zero bits (each level halving the fraction kept). The histograms are
+    computed at the end by looking up the estimated count of every kept k-mer, so the distinct k-mers are counted
+    exactly (or scaled up from the fraction kept) and only the depths are estimated. Collisions in a sketch that is
+    too small make these too high.
+    """
+    def __init__(self, k, memory):
+        if not 0 < k <= 32:
+            raise ValueError("The k-mer size must be between 1 and 32, not %d." % k)
+        self.k = k
+        width = 1 << max(10, (memory // (2 * SKETCH_ROWS * 4)).bit_length() - 1)
+        self.mask = np.uint64(width - 1)
+        self.sketch = np.zeros((SKETCH_ROWS, width), dtype=np.uint32)
+        self.seeds = mix(np.arange(1, SKETCH_ROWS + 1, dtype=np.uint64) * _GOLDEN)
+        # distinct k-mers (hash and bin), 12 bytes each
+        self.capacity = max(1024, memory // (2 * 12))
+        self.level = 0
+        self.keys = np.zeros(0, dtype=np.uint64)
+        self.keybins = np.zeros(0, dtype=np.int32)
+        self.pending = []
+        self.npending = 0
+        # bin 0 is the whole sample, the others the bins of every rank
+        self.bins = {}
+
+    def bin_id(self, rank, binname):
+        binid = self.bins.get((rank, binname))
+        if binid is None:
+            binid = self.bins[(rank, binname)] = len(self.bins) + 1
+        return binid
+
+    def add(self, otus, records):
+        """
+        Counts the k-mers of FASTQ records, each in the sample and in its bin of every rank (the OTU of the record).
+        """
+        with metrics.thread_stage("kmer_counting"):
+            self.count(otus, records)
+
+    def count(self, otus, records):
+        kmers, owner = canonical_kmers([record.split(b"\n", 2)[1] for record in records], self.k)
+        binids = [np.zeros(len(kmers), dtype=np.int32)]
+        for rank in range(len(otus[0]) if otus else 0):
+            ids = np.array([self.bin_id(rank, otu[rank]) for otu in otus], dtype=np.int32)
+            binids.append(ids[owner])
+        kmers = np.tile(kmers, len(binids))
+        binids = np.concatenate(binids)
+        keys, first, counts = np.unique(mix(kmers ^ (binids.astype(np.uint64) * _GOLDEN)), return_index=True,
+                                        return_counts=True)
+        for row, cell in enumerate(self.cells(keys)):
+            np.add.at(self.sketch[row], cell, counts.astype(np.uint32))
+        keep = self.sampled(keys)
+        self.pending.append((keys[keep], binids[first][keep]))
+        self.npending += int(np.count_nonzero(keep))
+        if self.npending >= self.capacity // 4:
+            self.merge()
+        metrics.count("kmers", len(owner))
+
+    def cells(self, keys):
+        """ Returns the cells of the given keys in every row of the sketch """
+        return [mix(keys ^ seed) & self.mask for seed in self.seeds]
+
+    def estimate(self, cells):
+        """ Returns the estimated counts of the k-mers hashed to the given cells of every row """
+        return np.min([self.sketch[row][cell] for row, cell in enumerate(cells)], axis=0).astype(np.int64)
+
+    def sampled(self, keys):
+        """ Returns which of the keys are kept at the current level """
+        if self.level == 0:
+            return np.ones(len(keys), dtype=bool)
+        return (mix(keys ^ _GOLDEN) >> np.uint64(64 - self.level)) == 0
+
+    def merge(self):
+        """ Adds the pending distinct k-mers to the kept ones, raising the level while there are too many """
+        keys = np.concatenate([self.keys] + [keys for keys, binids in self.pending])
+        binids = np.concatenate([self.keybins] + [binids for keys, binids in self.pending])
+        keys, first = np.unique(keys, return_index=True)
+        binids = binids[first]
+        while len(keys) > self.capacity:
+            self.level += 1
+            keep = self.sampled(keys)
+            keys = keys[keep]
+            binids = binids[keep]
+        self.keys = keys
+        self.keybins = binids
+        self.pending = []
+        self.npending = 0
+
+    def occupancy(self):
+        """ Returns the fraction of the cells of the sketch that are in use """
+        return np.count_nonzero(self.sketch) / self.sketch.size
+
+    def histograms(self):
+        """
+        Returns the histogram of the sample and of every bin.
+
+        (sample histogram, {(rank index, binname): histogram}) with histograms as (unique, raw) arrays per depth
+        """
+        self.merge()
+        occupancy = self.occupancy()
+        # a k-mer is overestimated if every row has a collision in its cell
+        overestimated = occupancy ** SKETCH_ROWS
+        logging.info("K-mer sketch %.1f%% in use, keeping 1/%d of the distinct k-mers"
+                     % (100 * occupancy, 1 << self.level))
+        if overestimated > MAX_OVERESTIMATED:
+            logging.warning("The k-mer sketch is too small: %.1f%% of its cells are in use, so about %.0f%% of the "
+                            "k-mer depths are too high. Raise --kmer-memory."
+                            % (100 * occupancy, 100 * overestimated))
+        depths = self.estimate(self.cells(self.keys))
+        # the last line holds all higher depths, with their true raw count
+        lines = np.minimum(depths, HIST_DEPTH)
+        scale = 1 << self.level
+        unique = np.zeros((len(self.bins) + 1, HIST_DEPTH + 1), dtype=np.int64)
+        raw = np.zeros((len(self.bins) + 1, HIST_DEPTH + 1), dtype=np.int64)
+        np.add.at(unique, (self.keybins, lines), scale)
+        np.add.at(raw, (self.keybins, lines), depths * scale)
+        bins = {key: (unique[binid], raw[binid]) for key, binid in self.bins.items()}
+        return (unique[0], raw[0]), bins
+
+
+def write_hist(histfile, histogram):
+    """
+    Writes a depth histogram in the format of BBMap khist.sh, up to the highest depth seen.
+    """
+    unique, raw = histogram
+    nonzero = np.flatnonzero(unique[1:])
+    with open(histfile, "w") as fout:
+        fout.write(HIST_HEADER)
+        for depth in range(1, nonzero[-1] + 2 if len(nonzero) else 1):
+            fout.write("%d\t%d\t%d\n" % (depth, raw[depth], unique[depth]))
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
-from ete3 import NCBITaxa
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from queue import Queue
-from threading import Thread
+from threading import Thread, local
+try:
+    from ete3 import NCBITaxa
+except ImportError:  # not needed when a compiled taxonomy index is loaded
+    NCBITaxa = None
+# local libraries
+import taxonomy_index
 
 """
 MIT License
@@ -58,29 +65,68 @@ class ThreadPool(object):
         self.tasks.join()
 
 
-def get_bin(taxrank, record_id, fqids):
+_thread_data = local()
+_taxonomy_index = None
+
+
+def load_taxonomy_index(indexdir):
     """
-    Returns the name of the taxonomic clade closest to the given rank where the given TaxID falls under.
+    Uses the index compiled by taxonomy_index.py for all lookups instead of the ete3 database.
+    """
+    global _taxonomy_index
+    _taxonomy_index = taxonomy_index.TaxonomyIndex(indexdir)
+
+
+def get_taxdb():
+    """
+    Returns the compiled taxonomy index if one is loaded. Otherwise returns the NCBITaxa instance of the calling
+    thread (the SQLite connection can not be shared between threads).
     """
-    taxdb = NCBITaxa()
-    lineage = [1]
+    if _taxonomy_index is not None:
+        return _taxonomy_index
+    if NCBITaxa is None:
+        raise ImportError("ete3 is not installed and no compiled taxonomy index was loaded.")
+    if not hasattr(_thread_data, "taxdb"):
+        _thread_data.taxdb = NCBITaxa()
+    return _thread_data.taxdb
+
+
+def get_bins(taxranks, taxid):
+    """
+    Returns the names of the taxonomic clades at the given ranks where the given TaxID falls under ("root" for the
+    ranks that are not in the lineage). The lineage is walked only once for all ranks.
+    """
+    taxdb = get_taxdb()
     try:
-        lineage = taxdb.get_lineage(fqids[record_id])[::-1]  # bottleneck for the script
+        lineage = taxdb.get_lineage(taxid)[::-1]  # bottleneck for the script
     except ValueError:
         #       logging.warning("Taxonomy ID %s not found" % taxonomy_id) # Generates a LOT of noise in the logs
-        fqids[record_id] = "root"
-        return
+        return ("root",) * len(taxranks)
     ranks = taxdb.get_rank(lineage)
-    target = tax_ranks.index(taxrank)
-    for clade in lineage:
-        try:
-            idx = tax_ranks.index(ranks[clade])
-        except ValueError:
-            continue
-        if idx == target:
-            fqids[record_id] = taxdb.get_taxid_translator([clade])[clade].lower()
-            return
-    fqids[record_id] = "root"
+    clades = {}
+    for clade in lineage:  # closest to the given TaxID first
+        clades.setdefault(ranks[clade], clade)
+    names = taxdb.get_taxid_translator([clades[rank] for rank in taxranks if rank in clades])
+    return tuple(names[clades[rank]].lower() if rank in clades else "root" for rank in taxranks)
+
+
+def get_bin(taxrank, record_id, fqids):
+    """
+    Returns the name of the taxonomic clade closest to the given rank where the given TaxID falls under.
+    """
+    fqids[record_id] = get_bins((taxrank,), fqids[record_id])[0]
+
+
+def resolve_taxids(taxranks, taxids, workerthreads):
+    """
+    Resolves the bins at the given ranks of every distinct TaxID only once, so the amount of lookups depends on the
+    amount of unique taxa instead of the amount of reads.
+
+    {taxid: (binname, ...)}
+    """
+    taxids = list(set(taxids))
+    with ThreadPoolExecutor(max(1, workerthreads)) as lineage_pool:
+        return dict(zip(taxids, lineage_pool.map(partial(get_bins, taxranks), map(int, taxids))))
 
 
 if __name__ == "__main__":
@@ -108,3 +154,15 @@ if __name__ == "__main__":
     print(fqids_threaded)
 
     assert fqids_normal == fqids_threaded
+    # Test memoized lookups
+    fqids_memoized = {
+        "READ:001": 9606,
+        "READ:002": 6433,
+        "READ:003": 1234,
+        "READ:004": 7654
+    }
+    taxid2bin = resolve_taxids(("phylum",), fqids_memoized.values(), 4)
+    fqids_memoized = {fqid: taxid2bin[taxid][0] for fqid, taxid in fqids_memoized.items()}
+    print(fqids_memoized)
+
+    assert fqids_normal == fqids_memoized
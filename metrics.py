@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import json
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+"""
+MIT License
+"""
+
+
+_lock = Lock()
+_stages = OrderedDict()
+_counters = OrderedDict()
+_started = time.perf_counter()
+_started_cpu = time.process_time()
+
+
+def reset():
+    """ Forgets all recorded timings and counters """
+    global _started, _started_cpu
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _started = time.perf_counter()
+        _started_cpu = time.process_time()
+
+
+@contextmanager
+def stage(name):
+    """
+    Records the wall and CPU time (of the whole process, so including helper threads) spent in the enclosed block.
+    """
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+
+@contextmanager
+def thread_stage(name):
+    """
+    Records the wall time and the CPU time of the calling thread spent in the enclosed block, for stages that run in
+    helper threads (or alongside them), where the CPU time of the process would include the other threads.
+    """
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+
+def add_time(name, wall, cpu):
+    """ Adds the wall and CPU time of a single call to a stage """
+    with _lock:
+        times = _stages.setdefault(name, OrderedDict([("wall_seconds", 0.0), ("cpu_seconds", 0.0), ("calls", 0)]))
+        times["wall_seconds"] += wall
+        times["cpu_seconds"] += cpu
+        times["calls"] += 1
+
+
+def count(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def get_count(name):
+    return _counters.get(name, 0)
+
+
+def peak_rss_mb():
+    """ Peak resident set size of this process and of its (finished) child processes """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
+
+
+def _rate(amount, stagename):
+    seconds = _stages.get(stagename, {}).get("wall_seconds", 0.0)
+    return amount / seconds if seconds > 0 else 0.0
+
+
+def report(bins=None, ratestage="binning"):
+    """
+    Returns the recorded metrics, with throughput rates relative to the wall time of the given stage.
+    """
+    own, children = peak_rss_mb()
+    with _lock:
+        result = OrderedDict()
+        result["wall_seconds"] = time.perf_counter() - _started
+        result["cpu_seconds"] = time.process_time() - _started_cpu
+        result["peak_rss_mb"] = own
+        result["peak_rss_children_mb"] = children
+        result["stages"] = OrderedDict((name, OrderedDict(times)) for name, times in _stages.items())
+        result["counters"] = OrderedDict(_counters)
+        rates = OrderedDict()
+        rates["reads_per_s"] = _rate(_counters.get("reads", 0), ratestage)
+        rates["input_mb_per_s"] = _rate(_counters.get("input_bytes", 0) / (1024 * 1024), ratestage)
+        rates["output_mb_per_s"] = _rate(_counters.get("output_bytes", 0) / (1024 * 1024), ratestage)
+        result["rates"] = rates
+        lookups = _counters.get("lineage_lookups", 0)
+        hits = _counters.get("lineage_cache_hits", 0)
+        result["lineage_cache_hit_rate"] = hits / (lookups + hits) if lookups + hits > 0 else 0.0
+        if bins is not None:
+            result["bins"] = bins
+    return result
+
+
+def write(path, bins=None, ratestage="binning"):
+    """ Writes the recorded metrics to a JSON file """
+    with open(path, "w") as fout:
+        json.dump(report(bins, ratestage), fout, indent=2)
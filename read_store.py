@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+"""
+MIT License
+"""
+
+
+# amount of Kaiju lines hashed at once while loading
+BATCH_SIZE = 1 << 20
+# 64-bit FNV-1a parameters, applied to 8-byte words instead of single bytes
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def hash_ids(fqids):
+    """
+    Hashes a list of read IDs (bytes) to 64-bit keys. The IDs are hashed as zero padded 8-byte words, vectorized over
+    all IDs at once. Words consisting only of padding are skipped, so the key does not depend on the batch.
+    """
+    ids = np.array(fqids, dtype=bytes)
+    width = -(-ids.itemsize // 8) * 8
+    if width != ids.itemsize:
+        ids = ids.astype("S%d" % width)
+    words = ids.view("<u8").reshape(len(ids), width // 8)
+    keys = np.full(len(ids), _FNV_OFFSET, dtype=np.uint64)
+    for word in words.T:
+        mixed = (keys ^ word) * _FNV_PRIME
+        mixed ^= mixed >> np.uint64(29)
+        keys = np.where(word != 0, mixed, keys)
+    return keys
+
+
+class ReadTaxidStore(object):
+    """
+    Compact mapping of read IDs to TaxIDs and bins. The read IDs are kept as a sorted array of 64-bit hashes with
+    parallel arrays holding the TaxID (until the bins are assigned) and bin index of each read. Bin index 0 is the
+    root bin, which is also returned for reads that are not in the store. The bins themselves are interned in the
+    small binnames table.
+    """
+    def __init__(self, keys, taxids, root="root"):
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.taxids = taxids[order]
+        self.bins = np.zeros(len(self.keys), dtype=np.int32)
+        self.binnames = [root]
+
+    @classmethod
+    def from_kaiju(cls, kaijufile, root="root"):
+        """
+        Loads the classified reads of a Kaiju result file.
+        """
+        keys = []
+        taxids = []
+        batch_ids = []
+        batch_taxids = []
+        with open(kaijufile, "rb") as fin:
+            for line in fin:
+                if line[0] != 67:  # b"C"
+                    continue
+                line = line.split()
+                batch_ids.append(line[1])
+                batch_taxids.append(int(line[2]))
+                if len(batch_ids) >= BATCH_SIZE:
+                    keys.append(hash_ids(batch_ids))
+                    taxids.append(np.array(batch_taxids, dtype=np.uint32))
+                    batch_ids = []
+                    batch_taxids = []
+        keys.append(hash_ids(batch_ids))
+        taxids.append(np.array(batch_taxids, dtype=np.uint32))
+        return cls(np.concatenate(keys), np.concatenate(taxids), root)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def unique_taxids(self):
+        return np.unique(self.taxids)
+
+    def assign_bins(self, taxid2bin):
+        """
+        Sets the bin of every read from the bin of its TaxID ({taxid: binname}). The TaxIDs are dropped afterwards,
+        leaving 12 bytes per read.
+        """
+        index = {self.binnames[0]: 0}
+        taxids, inverse = np.unique(self.taxids, return_inverse=True)
+        codes = np.array([index.setdefault(taxid2bin[taxid], len(index)) for taxid in taxids.tolist()],
+                         dtype=np.int32)
+        self.bins = codes[inverse].reshape(-1) if len(codes) else np.zeros(0, dtype=np.int32)
+        self.binnames = sorted(index, key=index.get)
+        self.taxids = None
+
+    def lookup(self, fqids):
+        """
+        Returns the bin indices of the given read IDs.
+        """
+        keys = hash_ids(fqids)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=np.int32)
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        return np.where(self.keys[pos] == keys, self.bins[pos], 0)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# standard libraries
+import argparse
+import logging
+import os
+import sys
+from traceback import format_exc
+# numpy
+import numpy as np
+
+"""
+MIT License
+"""
+_epilog = """
+This program compiles the nodes.dmp and names.dmp files of the NCBI Taxonomy
+(as shipped with the Kaiju database) into a compact binary index. The index
+consists of NumPy arrays indexed by TaxID (parent, rank code and name offset)
+that are memory-mapped when loaded, so lineages can be resolved without ete3,
+its SQLite database or network access.
+"""
+
+# files that make up a compiled index
+PARENT_FILE = "parent.npy"
+RANK_FILE = "rank.npy"
+NAME_OFFSET_FILE = "name_offsets.npy"
+NAME_FILE = "names.npy"
+RANK_NAME_FILE = "ranks.txt"
+# lineages deeper than this are assumed to contain a cycle
+MAX_DEPTH = 1000
+
+
+def main(args):
+    for dmpfile in ("nodes.dmp", "names.dmp"):
+        if not os.path.exists(os.path.join(args.dmpdir, dmpfile)):
+            raise FileNotFoundError("Taxonomy dump file %s does not exist." % os.path.join(args.dmpdir, dmpfile))
+    os.makedirs(args.output, exist_ok=True)
+    if not os.access(args.output, os.W_OK):
+        raise PermissionError("Writing to the output directory %s is not permitted." % args.output)
+
+    build_index(args.dmpdir, args.output)
+
+
+def read_dmp(dmpfile):
+    """
+    Yields the fields of every line in a NCBI Taxonomy dump file.
+    """
+    with open(dmpfile, "r") as fin:
+        for line in fin:
+            yield line.rstrip("\t|\n").split("\t|\t")
+
+
+def build_index(dmpdir, outdir):
+    """
+    Compiles nodes.dmp and names.dmp in the given directory into an index in the output directory.
+    """
+    logging.info("Reading %s ..." % os.path.join(dmpdir, "nodes.dmp"))
+    taxids = []
+    parents = []
+    rankcodes = []
+    ranknames = {}
+    for fields in read_dmp(os.path.join(dmpdir, "nodes.dmp")):
+        taxids.append(int(fields[0]))
+        parents.append(int(fields[1]))
+        rankcodes.append(ranknames.setdefault(fields[2], len(ranknames)))
+    if len(ranknames) > np.iinfo(np.uint8).max:
+        raise ValueError("Too many distinct taxonomic ranks (%d) to encode." % len(ranknames))
+    size = max(taxids) + 1
+    logging.info("Found %d taxa with %d distinct ranks (maximum TaxID %d)" % (len(taxids), len(ranknames), size - 1))
+
+    # parent 0 marks a TaxID that is not in the taxonomy
+    parent = np.zeros(size, dtype=np.int32)
+    parent[taxids] = parents
+    rank = np.zeros(size, dtype=np.uint8)
+    rank[taxids] = rankcodes
+
+    logging.info("Reading %s ..." % os.path.join(dmpdir, "names.dmp"))
+    names = {}
+    for fields in read_dmp(os.path.join(dmpdir, "names.dmp")):
+        if fields[3] == "scientific name":
+            names[int(fields[0])] = fields[1].encode("utf-8")
+    lengths = np.zeros(size, dtype=np.int64)
+    for taxid, name in names.items():
+        if taxid < size:
+            lengths[taxid] = len(name)
+    name_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(lengths, out=name_offsets[1:])
+    namedata = np.frombuffer(b"".join(names[taxid] for taxid in sorted(names) if taxid < size), dtype=np.uint8)
+
+    logging.info("Writing index to %s ..." % outdir)
+    np.save(os.path.join(outdir, PARENT_FILE), parent)
+    np.save(os.path.join(outdir, RANK_FILE), rank)
+    np.save(os.path.join(outdir, NAME_OFFSET_FILE), name_offsets)
+    np.save(os.path.join(outdir, NAME_FILE), namedata)
+    with open(os.path.join(outdir, RANK_NAME_FILE), "w") as fout:
+        for rankname in sorted(ranknames, key=ranknames.get):
+            fout.write(rankname + "\n")
+
+
+class TaxonomyIndex(object):
+    """ Memory-mapped NCBI Taxonomy compiled by build_index(), queried like ete3's NCBITaxa """
+    def __init__(self, indexdir):
+        self.parent = np.load(os.path.join(indexdir, PARENT_FILE), mmap_mode="r")
+        self.rank = np.load(os.path.join(indexdir, RANK_FILE), mmap_mode="r")
+        self.name_offsets = np.load(os.path.join(indexdir, NAME_OFFSET_FILE), mmap_mode="r")
+        self.names = np.load(os.path.join(indexdir, NAME_FILE), mmap_mode="r")
+        with open(os.path.join(indexdir, RANK_NAME_FILE), "r") as fin:
+            self.ranknames = [line.rstrip("\n") for line in fin]
+
+    def __contains__(self, taxid):
+        return 0 < taxid < len(self.parent) and self.parent[taxid] != 0
+
+    def get_lineage(self, taxid):
+        """ Returns the TaxIDs from the root down to the given TaxID """
+        taxid = int(taxid)
+        if taxid not in self:
+            raise ValueError("Taxonomy ID %d not found" % taxid)
+        lineage = [taxid]
+        while taxid != 1:
+            taxid = int(self.parent[taxid])
+            lineage.append(taxid)
+            if len(lineage) > MAX_DEPTH:
+                raise ValueError("Lineage of taxonomy ID %d does not end at the root" % lineage[0])
+        return lineage[::-1]
+
+    def get_rank(self, taxids):
+        """ {taxid: rank} """
+        return {taxid: self.ranknames[self.rank[taxid]] for taxid in taxids}
+
+    def get_name(self, taxid):
+        return bytes(self.names[self.name_offsets[taxid]:self.name_offsets[taxid + 1]]).decode("utf-8")
+
+    def get_taxid_translator(self, taxids):
+        """ {taxid: scientific name} """
+        return {taxid: self.get_name(taxid) for taxid in taxids}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog=sys.argv[0], description="Compiles the NCBI Taxonomy into a binary index.",
+                                     epilog=_epilog)
+    optional = parser._action_groups.pop()
+    required = parser.add_argument_group("required arguments")
+    # Required arguments
+    required.add_argument("dmpdir", help="Directory containing nodes.dmp and names.dmp (e.g. the Kaiju database)",
+                          action="store")
+    required.add_argument("output", help="Output directory for the compiled index", action="store")
+    # Standard arguments
+    optional.add_argument("-v", "--verbose", help="Increase verbosity level", action="count")
+    optional.add_argument("-q", "--silent", help="Suppresses output messages, overriding the --verbose argument",
+                          action="store_true")
+    optional.add_argument("-l", "--log", help="Set the logging output location", action="store",
+                          type=argparse.FileType('w'), default=sys.stderr)
+    optional.add_argument("-V", "--version", action="version", version="1.0")
+    parser._action_groups.append(optional)
+    args = parser.parse_args()
+
+    loglvl = logging.WARNING
+    if args.silent:
+        loglvl = logging.ERROR
+    elif not args.verbose:
+        pass
+    elif args.verbose >= 2:
+        loglvl = logging.DEBUG
+    elif args.verbose == 1:
+        loglvl = logging.INFO
+    logging.basicConfig(format="[%(asctime)s] %(levelname)s: %(message)s", level=loglvl, stream=args.log)
+    logging.debug("Setting verbosity level to %s" % logging.getLevelName(loglvl))
+
+    exitcode = 0
+    try:
+        main(args)
+    except Exception as ex:
+        exitcode = 1
+        logging.error(ex)
+        logging.debug(format_exc())
+    finally:
+        logging.debug("Shutting down logging system ...")
+        logging.shutdown()
+    sys.exit(exitcode)